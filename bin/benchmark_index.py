@@ -0,0 +1,97 @@
+"""Measure the throughput of OgdchPackagePlugin.before_dataset_index.
+
+Builds a synthetic catalog of search documents, shaped like the ones CKAN passes to
+the hook from ckan.lib.search.index.PackageSearchIndex.index_package, and reports
+how many documents per second the hook processes.
+
+Usage: python bin/benchmark_index.py [--datasets N] [--resources N] [--rounds N]
+"""
+
+import argparse
+import copy
+import json
+import time
+
+from ckanext.switzerland import helpers as sh
+from ckanext.switzerland.plugin import OgdchPackagePlugin
+
+LANGS = ["de", "fr", "it", "en"]
+
+
+def _multilang(text):
+    return {lang: "{} ({})".format(text, lang) for lang in LANGS}
+
+
+def _resource(i, j):
+    return {
+        "id": "resource-{}-{}".format(i, j),
+        "title": _multilang("Resource {} of dataset {}".format(j, i)),
+        "description": _multilang("Description of resource {}".format(j)),
+        "format": "CSV",
+        "rights": "NonCommercialAllowed-CommercialAllowed-ReferenceRequired",
+        "url": "https://example.com/{}/{}.csv".format(i, j),
+        "media_type": "text/csv",
+    }
+
+
+def _search_document(i, resources):
+    validated_dict = {
+        "id": "dataset-{}".format(i),
+        "name": "dataset-{}".format(i),
+        "type": "dataset",
+        "title": _multilang("Dataset {}".format(i)),
+        "description": _multilang("A synthetic dataset " * 20),
+        "keywords": {
+            lang: ["keyword-{}".format(k) for k in range(5)] for lang in LANGS
+        },
+        "contact_points": [{"name": "Contact", "email": "contact@example.com"}],
+        "relations": [{"label": "Relation", "url": "https://example.com"}],
+        "temporals": [{"start_date": "2020-01-01", "end_date": "2020-12-31"}],
+        "language": LANGS,
+        "resources": [_resource(i, j) for j in range(resources)],
+    }
+    search_data = {
+        "id": validated_dict["id"],
+        "name": validated_dict["name"],
+        "type": "dataset",
+        "validated_data_dict": json.dumps(validated_dict),
+        "contact_points": validated_dict["contact_points"],
+        "relations": validated_dict["relations"],
+        "temporals": validated_dict["temporals"],
+        "keywords": validated_dict["keywords"],
+        "language": validated_dict["language"],
+        "res_description": [r["description"] for r in validated_dict["resources"]],
+    }
+    return search_data
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--datasets", type=int, default=2000)
+    parser.add_argument("--resources", type=int, default=20)
+    parser.add_argument("--rounds", type=int, default=3)
+    args = parser.parse_args()
+
+    catalog = [_search_document(i, args.resources) for i in range(args.datasets)]
+    plugin = OgdchPackagePlugin()
+
+    print(
+        "{} datasets with {} resources each, orjson {}".format(
+            args.datasets,
+            args.resources,
+            "enabled" if getattr(sh, "orjson", None) else "not installed",
+        )
+    )
+    best = None
+    for _ in range(args.rounds):
+        documents = copy.deepcopy(catalog)
+        start = time.perf_counter()
+        for search_data in documents:
+            plugin.before_dataset_index(search_data)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    print("{:.0f} docs/sec".format(args.datasets / best))
+
+
+if __name__ == "__main__":
+    main()
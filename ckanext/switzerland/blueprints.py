@@ -1,5 +1,11 @@
+import datetime
+import hashlib
 import logging
-from typing import Optional, Union
+import os
+import unicodedata
+import zipfile
+from typing import Optional, Tuple, Union
+from urllib.parse import quote
 
 import ckan.lib.base as base
 import ckan.lib.helpers as h
@@ -8,7 +14,7 @@ import ckan.logic as logic
 import ckan.model as model
 import ckan.plugins.toolkit as toolkit
 import flask
-from ckan.common import _, c, current_user
+from ckan.common import _, current_user
 from ckan.lib import signals
 from ckan.lib.dictization.model_dictize import resource_dictize
 from ckan.lib.plugins import lookup_package_plugin
@@ -16,8 +22,16 @@ from ckan.types import Context, Response
 from ckan.views.dataset import search
 from flask import Blueprint
 from werkzeug.wrappers.response import Response as WerkzeugResponse
+from werkzeug.wsgi import FileWrapper
 
-from ckanext.switzerland.helpers import resource_filename
+from ckanext.dcat import utils as dcat_utils
+from ckanext.dcat.exceptions import RDFProfileException
+from ckanext.dcat.helpers import endpoints_enabled
+from ckanext.switzerland.cache import LRUCache
+from ckanext.switzerland.dcat.processors import STREAMABLE_FORMATS, SwissRDFSerializer
+from ckanext.switzerland.harvester.formats import open_zip_member, read_zip_members
+from ckanext.switzerland.helpers import guess_media_type, resource_filename
+from ckanext.switzerland.logic import catalog_pagination_info, search_catalog_datasets
 
 log = logging.getLogger(__name__)
 render = toolkit.render
@@ -36,6 +50,20 @@ lookup_package_plugin = lookup_package_plugin
 
 ogdch_dataset = Blueprint("ogdch_dataset", __name__, url_prefix="/dataset")
 ogdch_home = Blueprint("ogdch_home", __name__, url_defaults={"package_type": "dataset"})
+ogdch_catalog = Blueprint("ogdch_catalog", __name__)
+
+# Resolved permalinks by dataset id: the permalink of each dataset, and the URLs of
+# its resources by filename. Each entry holds the metadata_modified of the dataset it
+# was resolved from. Every change of a dataset or its resources goes through
+# package_update, which sets a new metadata_modified, so that changes made by any
+# process (e.g. the harvesters) are noticed.
+dataset_permalinks = LRUCache(maxsize=4096)
+resource_permalinks = LRUCache(maxsize=1024)
+
+# Members of uploaded zip files by resource id, read from their central directory.
+# Each entry holds the ETag of the file it was read from (see
+# _get_download_validators), which changes when a new file is uploaded.
+zip_members = LRUCache(maxsize=256)
 
 
 def resource_download(
@@ -53,29 +81,54 @@ def resource_download(
         + rsc = resource_dictize(resource_obj, {'model': model})
     2. set Content-Disposition: attachment header so that resource files are
        downloaded, not opened in browser
+    3. answer conditional requests with an ETag derived from the resource id, size
+       and last modification, and return 304 Not Modified before the file is
+       opened. Byte ranges are handled by flask.send_file.
+    4. hand the file over to the web server in front of CKAN if
+       ckanext.switzerland.download_offload is set (see _offload_download)
+    5. check the access to the dataset without package_show:
+        - get_action('package_show')(context, {'id': id})
+        + _get_authorized_package(id)
+       and check that the resource belongs to that dataset, as the access is not
+       checked for the resource itself
     """
-    context: Context = {"user": current_user.name, "auth_user_obj": current_user}
-
     resource_obj = model.Resource.get(resource_id)
     if resource_obj is None:
         return base.abort(404, _("Resource not found"))
 
-    rsc = resource_dictize(resource_obj, {"model": model})
-
     try:
-        get_action("package_show")(context, {"id": id})
+        package = _get_authorized_package(id)
+    except NotFound:
+        return base.abort(404, _("Dataset not found"))
     except NotAuthorized:
         return base.abort(403, _("Not authorized to download resource"))
+    if resource_obj.package_id != package.id:
+        return base.abort(404, _("Resource not found"))
+
+    rsc = resource_dictize(resource_obj, {"model": model})
 
     if rsc.get("url_type") == "upload":
+        etag, last_modified = _get_download_validators(resource_obj)
+        if _is_not_modified(etag, last_modified):
+            resp = flask.Response(status=304)
+            resp.set_etag(etag)
+            resp.last_modified = last_modified
+            return resp
+
         upload = uploader.get_resource_uploader(rsc)
         filepath = upload.get_path(rsc["id"])
-        resp = flask.send_file(
-            filepath,
-            as_attachment=True,
-            download_name=filename,
-            mimetype=rsc.get("mimetype"),
-        )
+        resp = _offload_download(upload, filepath, filename, rsc.get("mimetype"))
+        if resp is None:
+            resp = flask.send_file(
+                filepath,
+                as_attachment=True,
+                download_name=filename,
+                mimetype=rsc.get("mimetype"),
+                etag=etag,
+                last_modified=last_modified,
+            )
+        resp.set_etag(etag)
+        resp.last_modified = last_modified
 
         signals.resource_download.send(resource_id)
         return resp
@@ -85,50 +138,335 @@ def resource_download(
     return h.redirect_to(rsc["url"])
 
 
-def resource_permalink(id, filename):
-    context = {
+def _get_download_validators(
+    resource_obj: model.Resource,
+) -> Tuple[str, Optional[datetime.datetime]]:
+    """Return the ETag and the Last-Modified date of an uploaded resource file.
+    Both change whenever a new file is uploaded.
+    """
+    last_modified = (
+        resource_obj.last_modified
+        or resource_obj.metadata_modified
+        or resource_obj.created
+    )
+    if last_modified:
+        # HTTP dates have no microseconds, and the database stores UTC times
+        last_modified = last_modified.replace(
+            microsecond=0, tzinfo=datetime.timezone.utc
+        )
+
+    version = "{}-{}-{}".format(
+        resource_obj.id,
+        resource_obj.size,
+        last_modified.isoformat() if last_modified else "",
+    )
+    return hashlib.sha1(version.encode("utf8")).hexdigest(), last_modified
+
+
+def _offload_download(
+    upload, filepath: str, filename: Optional[str], mimetype: Optional[str]
+) -> Optional[Response]:
+    """Return a response that tells the web server in front of CKAN to send the
+    file, without reading it in this worker:
+
+    - x-sendfile: the X-Sendfile header holds the path of the file (Apache
+      mod_xsendfile, lighttpd)
+    - x-accel-redirect: the X-Accel-Redirect header holds the path of the file
+      relative to the resource storage, below the internal nginx location
+      ckanext.switzerland.download_offload_location
+
+    Returns None if ckanext.switzerland.download_offload is not set, or if the file
+    is not in the local resource storage (e.g. with an uploader for a cloud
+    storage), in which case the file is sent by flask.send_file.
+    """
+    mode = toolkit.config.get("ckanext.switzerland.download_offload")
+    if not mode:
+        return None
+
+    storage_path = getattr(upload, "storage_path", None)
+    if not isinstance(storage_path, str):
+        return None
+    relative_path = os.path.relpath(filepath, storage_path)
+    if relative_path.startswith(os.pardir):
+        return None
+
+    download_name = filename or os.path.basename(filepath)
+    resp = flask.Response(
+        mimetype=mimetype
+        or guess_media_type(download_name)
+        or "application/octet-stream"
+    )
+    if mode == "x-sendfile":
+        resp.headers["X-Sendfile"] = filepath
+    elif mode == "x-accel-redirect":
+        location = toolkit.config.get(
+            "ckanext.switzerland.download_offload_location", "/_resource_files/"
+        )
+        resp.headers["X-Accel-Redirect"] = quote(
+            "{}/{}".format(location.rstrip("/"), relative_path)
+        )
+    else:
+        log.error("Unknown ckanext.switzerland.download_offload: {}".format(mode))
+        return None
+
+    _set_attachment(resp, download_name)
+    return resp
+
+
+def _set_attachment(resp: Response, download_name: str) -> None:
+    """Set the Content-Disposition: attachment header of a response."""
+    # Same as flask.send_file for names that can not be encoded in ASCII
+    try:
+        download_name.encode("ascii")
+    except UnicodeEncodeError:
+        simple = unicodedata.normalize("NFKD", download_name)
+        names = {
+            "filename": simple.encode("ascii", "ignore").decode("ascii"),
+            "filename*": "UTF-8''{}".format(quote(download_name, safe="!#$&+^`|~")),
+        }
+    else:
+        names = {"filename": download_name}
+    resp.headers.set("Content-Disposition", "attachment", **names)
+
+
+def resource_zip_member(
+    id: str, resource_id: str, member: str
+) -> Union[Response, WerkzeugResponse]:
+    """
+    Provides the download of one file (member) of an uploaded zip file, so that
+    the whole zip file does not have to be downloaded to get it.
+
+    The member is located through the central directory of the zip file, which is
+    read once per upload and cached in zip_members, so that only the member itself
+    is read. It is decompressed while it is sent. The access is checked and
+    conditional requests are answered as in resource_download.
+    """
+    resource_obj = model.Resource.get(resource_id)
+    if resource_obj is None:
+        return base.abort(404, _("Resource not found"))
+
+    try:
+        package = _get_authorized_package(id)
+    except NotFound:
+        return base.abort(404, _("Dataset not found"))
+    except NotAuthorized:
+        return base.abort(403, _("Not authorized to download resource"))
+    if resource_obj.package_id != package.id:
+        return base.abort(404, _("Resource not found"))
+
+    if resource_obj.url_type != "upload":
+        return base.abort(404, _("No download is available"))
+
+    etag, last_modified = _get_download_validators(resource_obj)
+    # Every member has its own ETag, which changes with the one of the zip file
+    member_etag = hashlib.sha1("{}/{}".format(etag, member).encode("utf8")).hexdigest()
+    if _is_not_modified(member_etag, last_modified):
+        resp = flask.Response(status=304)
+        resp.set_etag(member_etag)
+        resp.last_modified = last_modified
+        return resp
+
+    rsc = resource_dictize(resource_obj, {"model": model})
+    filepath = uploader.get_resource_uploader(rsc).get_path(rsc["id"])
+    zip_member = _get_zip_members(resource_id, filepath, etag).get(member)
+    if zip_member is None or zip_member.is_dir():
+        return base.abort(404, _("File not found in the zip file"))
+
+    resp = _send_zip_member(rsc["id"], filepath, zip_member)
+    resp.set_etag(member_etag)
+    resp.last_modified = last_modified
+
+    signals.resource_download.send(resource_id)
+    return resp
+
+
+def _send_zip_member(
+    resource_id: str, filepath: str, zip_member: zipfile.ZipInfo
+) -> Union[Response, WerkzeugResponse]:
+    """Return a response that sends a member of the zip file at filepath, which is
+    decompressed while it is sent.
+    """
+    f = open(filepath, "rb")
+    try:
+        member_file = open_zip_member(f, zip_member)
+    except (zipfile.BadZipFile, NotImplementedError, RuntimeError) as e:
+        # e.g. the member is encrypted or compressed with an unsupported method
+        f.close()
+        log.warning(
+            "Could not read {} of resource {}: {}".format(
+                zip_member.filename, resource_id, e
+            )
+        )
+        return base.abort(501, _("The file can not be extracted from the zip file"))
+
+    download_name = os.path.basename(zip_member.filename)
+    resp = flask.Response(
+        FileWrapper(member_file),
+        mimetype=guess_media_type(download_name) or "application/octet-stream",
+        direct_passthrough=True,
+    )
+    resp.call_on_close(f.close)
+    resp.content_length = zip_member.file_size
+    _set_attachment(resp, download_name)
+    return resp
+
+
+def _get_zip_members(resource_id: str, filepath: str, etag: str) -> dict:
+    """Return the members of the uploaded zip file of a resource by their name, or
+    an empty dict if the file is not a zip file that can be read.
+    """
+    cached = zip_members.get(resource_id)
+    if cached is not None and cached[0] == etag:
+        return cached[1]
+
+    try:
+        with open(filepath, "rb") as f:
+            members = read_zip_members(f) or []
+    except OSError:
+        log.warning("Could not open the file of resource {}".format(resource_id))
+        return {}
+
+    members = {zip_member.filename: zip_member for zip_member in members}
+    zip_members.set(resource_id, (etag, members))
+    return members
+
+
+def _is_not_modified(etag: str, last_modified: Optional[datetime.datetime]) -> bool:
+    request = flask.request
+    # If-Modified-Since is ignored if the request has an If-None-Match header
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    if request.if_modified_since and last_modified:
+        return last_modified <= request.if_modified_since
+    return False
+
+
+def _get_authorized_package(id: str) -> model.Package:
+    """Return the dataset with the given id or name if the user may read it.
+
+    Runs the same authorization as package_show, but does not validate, dictize or
+    pass the dataset through the plugins, as the routes below only need a few of
+    its fields.
+    """
+    package = model.Package.get(id)
+    if package is None:
+        raise NotFound(_("Dataset not found"))
+
+    context: Context = {
         "model": model,
         "session": model.Session,
-        "user": c.user or c.author,
-        "for_view": True,
-        "auth_user_obj": c.userobj,
+        "user": current_user.name,
+        "auth_user_obj": current_user,
+        "package": package,
     }
-    data_dict = {"id": id, "include_tracking": True}
+    check_access("package_show", context, {"id": package.id})
+    return package
+
 
+def resource_permalink(id, filename):
     try:
-        dataset = get_action("package_show")(context, data_dict)
+        package = _get_authorized_package(id)
     except NotFound:
         abort(404, _("Dataset not found"))
     except NotAuthorized:
         abort(401, _("Unauthorized to read package %s") % id)
 
-    for res in dataset["resources"]:
-        if resource_filename(res["url"]) == filename:
-            return redirect(res["url"])
+    url = _get_resource_permalinks(package).get(filename)
+    if not url:
+        abort(404, _("Resource not found"))
 
-    abort(404, _("Resource not found"))
+    return redirect(url)
 
 
 def dataset_permalink(id):
-    context = {
-        "model": model,
-        "session": model.Session,
-        "user": c.user or c.author,
-        "for_view": True,
-        "auth_user_obj": c.userobj,
-    }
-    data_dict = {"id": id, "include_tracking": True}
     try:
-        dataset = get_action("package_show")(context, data_dict)
+        package = _get_authorized_package(id)
     except NotFound:
         abort(404, _("Dataset not found"))
     except NotAuthorized:
         abort(401, _("Unauthorized to read package %s") % id)
 
-    if not dataset["permalink"]:
+    permalink = _get_dataset_permalink(package)
+    if not permalink:
         abort(404, _("Resource not found"))
 
-    return redirect(dataset["permalink"])
+    return redirect(permalink)
+
+
+def _get_dataset_permalink(package: model.Package) -> Optional[str]:
+    cached = dataset_permalinks.get(package.id)
+    if cached is not None and cached[0] == package.metadata_modified:
+        return cached[1]
+
+    permalink = package.extras.get("permalink")
+    dataset_permalinks.set(package.id, (package.metadata_modified, permalink))
+    return permalink
+
+
+def _get_resource_permalinks(package: model.Package) -> dict:
+    """Return the URLs of the active resources of a dataset by their filename. If
+    several resources have the same filename, the first one is used.
+    """
+    cached = resource_permalinks.get(package.id)
+    if cached is not None and cached[0] == package.metadata_modified:
+        return cached[1]
+
+    resources = (
+        model.Session.query(model.Resource)
+        .filter(model.Resource.package_id == package.id)
+        .filter(model.Resource.state == "active")
+        .order_by(model.Resource.position)
+    )
+    urls = {}
+    for resource_obj in resources:
+        filename = resource_filename(resource_obj.url)
+        if filename not in urls:
+            urls[filename] = resource_dictize(resource_obj, {"model": model})["url"]
+
+    resource_permalinks.set(package.id, (package.metadata_modified, urls))
+    return urls
+
+
+def read_catalog(_format: str) -> Response:
+    """Same as the catalog endpoint of ckanext-dcat, but streams the formats in
+    STREAMABLE_FORMATS dataset by dataset, see SwissRDFSerializer. Other formats
+    are served by ckanext-dcat.
+    """
+    rdflib_format = dcat_utils.url_to_rdflib_format(_format)
+    if (
+        _format not in dcat_utils.CONTENT_TYPES
+        or rdflib_format not in STREAMABLE_FORMATS
+    ):
+        return dcat_utils.read_catalog_page(_format)
+
+    profiles = toolkit.request.args.get("profiles")
+    data_dict = {
+        "page": toolkit.request.args.get("page"),
+        "modified_since": toolkit.request.args.get("modified_since"),
+        "q": toolkit.request.args.get("q"),
+        "fq": toolkit.request.args.get("fq"),
+        "format": _format,
+        "profiles": profiles.split(",") if profiles else None,
+    }
+    context = {}
+
+    try:
+        check_access("dcat_catalog_show", context, data_dict)
+        query = search_catalog_datasets(context, data_dict)
+        pagination_info = catalog_pagination_info(query, data_dict)
+        serializer = SwissRDFSerializer(profiles=data_dict["profiles"])
+    except NotAuthorized:
+        return base.abort(403, _("Not authorized to read the catalog"))
+    except (ValidationError, RDFProfileException) as e:
+        return base.abort(409, str(e))
+
+    chunks = serializer.iter_serialize_catalog(
+        {}, query["results"], rdflib_format, pagination_info
+    )
+    return flask.Response(
+        flask.stream_with_context(chunks),
+        mimetype=dcat_utils.CONTENT_TYPES[_format],
+    )
 
 
 ogdch_dataset.add_url_rule(
@@ -137,9 +475,22 @@ ogdch_dataset.add_url_rule(
 ogdch_dataset.add_url_rule(
     "/<id>/resource/<resource_id>/download/<filename>", view_func=resource_download
 )
+ogdch_dataset.add_url_rule(
+    "/<id>/resource/<resource_id>/member/<path:member>",
+    view_func=resource_zip_member,
+)
 ogdch_dataset.add_url_rule(
     "/<id>/resource_permalink/<filename>", view_func=resource_permalink
 )
 ogdch_dataset.add_url_rule("/<id>/permalink", view_func=dataset_permalink)
 
 ogdch_home.add_url_rule("/", view_func=search, strict_slashes=False)
+
+# Registered before the catalog endpoint of ckanext-dcat, see OgdchPlugin.
+if endpoints_enabled():
+    ogdch_catalog.add_url_rule(
+        toolkit.config.get(
+            "ckanext.dcat.catalog_endpoint", dcat_utils.DEFAULT_CATALOG_ENDPOINT
+        ).replace("{_format}", "<_format>"),
+        view_func=read_catalog,
+    )
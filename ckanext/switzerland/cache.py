@@ -0,0 +1,48 @@
+import threading
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """
+    A small, thread-safe least-recently-used cache.
+
+    Used to keep lookups that are expensive to compute (database or Solr queries)
+    in memory for the lifetime of the process. Entries are evicted in
+    least-recently-used order once maxsize is reached.
+    """
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                self._data.move_to_end(key)
+            except KeyError:
+                return default
+            return self._data[key]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._data.pop(key, default)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._data
+
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
@@ -0,0 +1,166 @@
+import multiprocessing as mp
+
+import ckan.model as model
+import ckan.plugins.toolkit as tk
+import click
+from ckan.lib import search
+
+from ckanext.switzerland.logic import (
+    CLEANUP_BATCH_SIZE,
+    REINDEX_BATCH_SIZE,
+    get_package_ids_to_reindex,
+    reindex_packages,
+)
+
+
+def get_commands():
+    return [ogdch]
+
+
+@click.group()
+def ogdch():
+    """Commands for ckanext-switzerland."""
+    pass
+
+
+@ogdch.command("cleanup-harvestjobs")
+@click.option(
+    "--source",
+    "harvest_source_id",
+    help="Id of the harvest source to clean up. Defaults to all sources.",
+)
+@click.option(
+    "--keep",
+    type=int,
+    help="Number of finished jobs to keep per source. Defaults to "
+    "ckanext.switzerland.number_harvest_jobs_per_source.",
+)
+@click.option(
+    "--batch-size",
+    type=int,
+    default=CLEANUP_BATCH_SIZE,
+    show_default=True,
+    help="Number of harvest objects to delete per transaction.",
+)
+@click.option(
+    "--sleep-between-batches",
+    type=float,
+    default=0,
+    show_default=True,
+    help="Seconds to wait between two batches.",
+)
+@click.option(
+    "--max-runtime",
+    type=int,
+    help="Stop after this many seconds. The next run continues the cleanup.",
+)
+@click.option(
+    "--dry-run",
+    is_flag=True,
+    help="Only count the jobs and objects that would be deleted.",
+)
+def cleanup_harvestjobs(
+    harvest_source_id, keep, batch_size, sleep_between_batches, max_runtime, dry_run
+):
+    """Delete old harvest jobs and their objects, keeping the latest jobs of each
+    harvest source.
+    """
+    if keep is None:
+        keep = tk.config.get("ckanext.switzerland.number_harvest_jobs_per_source")
+    if keep is None:
+        tk.error_shout(
+            "Please set ckanext.switzerland.number_harvest_jobs_per_source or pass "
+            "--keep"
+        )
+        raise click.Abort()
+
+    data_dict = {
+        "number_of_jobs_to_keep": tk.asint(keep),
+        "batch_size": batch_size,
+        "sleep_between_batches": sleep_between_batches,
+        "max_runtime": max_runtime,
+        "dryrun": dry_run,
+    }
+    if harvest_source_id:
+        data_dict["harvest_source_id"] = harvest_source_id
+
+    site_user = tk.get_action("get_site_user")({"ignore_auth": True}, {})
+    try:
+        result = tk.get_action("ogdch_cleanup_harvestjobs")(
+            {"user": site_user["name"]}, data_dict
+        )
+    except tk.ObjectNotFound as e:
+        tk.error_shout(e)
+        raise click.Abort()
+
+    for source_id, source_result in result["cleanup"].items():
+        click.echo(
+            "{}: {} {} jobs and {} objects".format(
+                source_id,
+                "would delete" if dry_run else "deleted",
+                source_result["deleted_nr_jobs"],
+                source_result["deleted_nr_objects"],
+            )
+        )
+
+    if not result["finished"]:
+        click.echo("Maximum runtime reached, the cleanup is not complete yet")
+
+
+@ogdch.command("reindex")
+@click.option(
+    "--since",
+    type=click.DateTime(),
+    help="Only reindex datasets whose metadata_modified is at or after this date.",
+)
+@click.option(
+    "--processes",
+    type=int,
+    default=mp.cpu_count(),
+    show_default=True,
+    help="Number of worker processes.",
+)
+@click.option(
+    "--batch-size",
+    type=int,
+    default=REINDEX_BATCH_SIZE,
+    show_default=True,
+    help="Number of datasets a worker indexes at a time.",
+)
+def reindex(since, processes, batch_size):
+    """Rebuild the search index using several processes. The datasets are split
+    into batches of ids that the workers index without committing, and Solr is
+    committed once at the end.
+    """
+    package_ids = get_package_ids_to_reindex(since)
+    batches = [
+        package_ids[i : i + batch_size] for i in range(0, len(package_ids), batch_size)
+    ]
+    click.echo(
+        "Reindexing {} datasets in {} batches".format(len(package_ids), len(batches))
+    )
+
+    failed = []
+    if processes > 1 and len(batches) > 1:
+        # The workers must not share the database connections of this process.
+        model.Session.remove()
+        model.meta.engine.dispose()
+        with mp.get_context("fork").Pool(
+            processes, initializer=_init_reindex_worker
+        ) as pool:
+            for batch_failed in pool.imap_unordered(reindex_packages, batches):
+                failed.extend(batch_failed)
+    else:
+        for batch in batches:
+            failed.extend(reindex_packages(batch))
+
+    search.commit()
+
+    click.echo("Indexed {} datasets".format(len(package_ids) - len(failed)))
+    if failed:
+        tk.error_shout("Could not index these datasets: {}".format(", ".join(failed)))
+        raise click.Abort()
+
+
+def _init_reindex_worker():
+    model.meta.engine.dispose(close=False)
@@ -1,9 +1,36 @@
+import hashlib
+import json
 import logging
+import time
+import traceback
+
+import ckan.model as model
+import ckan.plugins as p
+import ckan.plugins.toolkit as tk
 
 from ckanext.dcat.harvesters.rdf import DCATRDFHarvester
+from ckanext.dcat.interfaces import IDCATRDFHarvester
+from ckanext.dcat.processors import (
+    RDF_PROFILES_CONFIG_OPTION,
+    RDFParser,
+    RDFParserException,
+)
+from ckanext.dcat.utils import url_to_rdflib_format
+from ckanext.harvest.model import HarvestObject, HarvestObjectExtra
+from ckanext.switzerland.dcat.processors import (
+    LINE_BASED_FORMATS,
+    LineBasedDatasetWindows,
+)
 
 log = logging.getLogger(__name__)
 
+# Number of datasets of an N-Triples or N-Quads page that are parsed into one graph
+# in the gather stage. Can be set per source with "window_size" in the source config.
+GATHER_WINDOW_SIZE = 100
+
+# Key of the harvest object extra that holds the fingerprint of the harvested dataset
+FINGERPRINT_EXTRA = "fingerprint"
+
 
 class SwissDCATRDFHarvester(DCATRDFHarvester):
     def info(self):
@@ -13,6 +40,310 @@ class SwissDCATRDFHarvester(DCATRDFHarvester):
             "description": "Harvester for DCAT-AP Switzerland datasets from an RDF graph",
         }
 
+    def validate_config(self, source_config):
+        source_config = super(SwissDCATRDFHarvester, self).validate_config(
+            source_config
+        )
+        if not source_config:
+            return source_config
+
+        source_config_obj = json.loads(source_config)
+        window_size = source_config_obj.get("window_size")
+        if window_size is not None and (
+            not isinstance(window_size, int) or window_size < 1
+        ):
+            raise ValueError("window_size must be a positive integer")
+
+        profiles = source_config_obj.get("profiles")
+        if profiles is not None and not (
+            isinstance(profiles, str)
+            or (
+                isinstance(profiles, list)
+                and all(isinstance(profile, str) for profile in profiles)
+            )
+        ):
+            raise ValueError("profiles must be a list of profile names")
+
+        import_rate = source_config_obj.get("import_rate")
+        if import_rate is not None and (
+            not isinstance(import_rate, (int, float)) or import_rate <= 0
+        ):
+            raise ValueError("import_rate must be a positive number")
+
+        return source_config
+
+    def gather_stage(self, harvest_job):
+        """
+        Copied from ckanext-dcat and changed to keep only a bounded part of the
+        remote catalog in memory: N-Triples and N-Quads pages are parsed in windows
+        of window_size datasets, and the graph of each page is released before the
+        next page of a paginated (Hydra) source is downloaded. Other formats are
+        parsed a whole page at a time.
+
+        The datasets are parsed with the RDF profiles set with "profiles" in the
+        source config, or else with the ones of ckanext.dcat.rdf.profiles.
+
+        Datasets that have not changed since they were last imported are not
+        gathered again, unless "force_all" is set in the source config. Each dataset
+        gets one harvest object per job, even if it is found several times in the
+        source, so that several fetch consumers can import the objects of a job in
+        parallel without importing the same dataset at the same time.
+        """
+        log.debug("In SwissDCATRDFHarvester gather_stage")
+
+        source_config = json.loads(harvest_job.source.config or "{}")
+        rdf_format = source_config.get("rdf_format")
+        window_size = source_config.get("window_size", GATHER_WINDOW_SIZE)
+        source_dataset = model.Package.get(harvest_job.source.id)
+
+        next_page_url = harvest_job.source.url
+        guids_in_source = []
+        object_ids = []
+        last_content_hash = None
+        self._names_taken = []
+        self._unchanged = 0
+        self._gathered = {}
+        self._profiles = self._get_profiles(source_config)
+        self._fingerprints = (
+            {}
+            if source_config.get("force_all")
+            else self._get_previous_fingerprints(harvest_job)
+        )
+
+        while next_page_url:
+            next_page_url = self._before_download(next_page_url, harvest_job)
+            if not next_page_url:
+                return []
+
+            content, rdf_format = self._get_content_and_type(
+                next_page_url, harvest_job, 1, content_type=rdf_format
+            )
+
+            content_hash = hashlib.md5((content or "").encode("utf8")).digest()
+            if content_hash == last_content_hash:
+                log.warning(
+                    "Remote content was the same even when using a paginated URL, "
+                    "skipping"
+                )
+                break
+            last_content_hash = content_hash
+
+            content = self._after_download(content, harvest_job)
+            if not content:
+                return []
+
+            next_page_url = None
+            try:
+                for parser in self._iter_parsers(
+                    content, rdf_format, window_size, harvest_job
+                ):
+                    if not parser:
+                        return []
+                    object_ids.extend(
+                        self._gather_datasets(
+                            parser, harvest_job, source_dataset, guids_in_source
+                        )
+                    )
+                    next_page_url = parser.next_page() or next_page_url
+            except RDFParserException as e:
+                self._save_gather_error(
+                    "Error parsing the RDF file: {0}".format(e), harvest_job
+                )
+                return []
+            except Exception as e:
+                self._save_gather_error(
+                    "Error when processing dataset: %r / %s"
+                    % (e, traceback.format_exc()),
+                    harvest_job,
+                )
+                return []
+
+        log.info(
+            "Gathered {} datasets, skipped {} unchanged datasets".format(
+                len(object_ids), self._unchanged
+            )
+        )
+
+        # Check if some datasets need to be deleted
+        object_ids.extend(
+            self._mark_datasets_for_deletion(guids_in_source, harvest_job)
+        )
+
+        return object_ids
+
+    def _before_download(self, url, harvest_job):
+        for harvester in p.PluginImplementations(IDCATRDFHarvester):
+            url, before_download_errors = harvester.before_download(url, harvest_job)
+
+            for error_msg in before_download_errors:
+                self._save_gather_error(error_msg, harvest_job)
+
+            if not url:
+                return None
+
+        return url
+
+    def _after_download(self, content, harvest_job):
+        for harvester in p.PluginImplementations(IDCATRDFHarvester):
+            content, after_download_errors = harvester.after_download(
+                content, harvest_job
+            )
+
+            for error_msg in after_download_errors:
+                self._save_gather_error(error_msg, harvest_job)
+
+        return content
+
+    def _iter_parsers(self, content, rdf_format, window_size, harvest_job):
+        """Yield parsers for the content of a page: one per window of datasets for
+        line-based formats, the first of them with the pagination statements, or a
+        single one for the whole page for other formats. Yields None if an
+        IDCATRDFHarvester plugin discarded a parser.
+        """
+        if url_to_rdflib_format(rdf_format) not in LINE_BASED_FORMATS:
+            yield self._parse(content, rdf_format, harvest_job)
+            return
+
+        windows = LineBasedDatasetWindows(content, window_size)
+        log.debug(
+            "Parsing {} datasets in windows of {}".format(
+                len(windows.datasets), window_size
+            )
+        )
+        for window in windows:
+            yield self._parse(window, rdf_format, harvest_job)
+
+    def _get_profiles(self, source_config):
+        profiles = source_config.get("profiles") or tk.config.get(
+            RDF_PROFILES_CONFIG_OPTION
+        )
+        if isinstance(profiles, str):
+            profiles = profiles.split()
+        return profiles or None
+
+    def _parse(self, content, rdf_format, harvest_job):
+        parser = RDFParser(profiles=self._profiles)
+        parser.parse(content, _format=rdf_format)
+
+        for harvester in p.PluginImplementations(IDCATRDFHarvester):
+            parser, after_parsing_errors = harvester.after_parsing(parser, harvest_job)
+
+            for error_msg in after_parsing_errors:
+                self._save_gather_error(error_msg, harvest_job)
+
+        return parser
+
+    def _gather_datasets(self, parser, harvest_job, source_dataset, guids_in_source):
+        object_ids = []
+        for dataset in parser.datasets():
+            fingerprint = self._get_fingerprint(dataset, harvest_job)
+            self._set_unique_name(dataset)
+
+            # Unless already set by the parser, get the owner organization (if any)
+            # from the harvest source dataset
+            if not dataset.get("owner_org") and source_dataset.owner_org:
+                dataset["owner_org"] = source_dataset.owner_org
+
+            # Try to get a unique identifier for the harvested dataset
+            guid = self._get_guid(dataset, source_url=source_dataset.url)
+
+            if not guid:
+                self._save_gather_error(
+                    "Could not get a unique identifier for dataset: {0}".format(
+                        dataset
+                    ),
+                    harvest_job,
+                )
+                continue
+
+            guids_in_source.append(guid)
+            dataset["extras"].append({"key": "guid", "value": guid})
+            if guid in self._gathered:
+                # The last statement of a dataset wins, as if its objects were
+                # imported one after the other
+                log.warning("Dataset {} was found more than once".format(guid))
+                self._update_object(self._gathered[guid], dataset, fingerprint)
+                continue
+
+            if self._fingerprints.get(guid) == fingerprint:
+                self._unchanged += 1
+                continue
+
+            obj = HarvestObject(
+                guid=guid,
+                job=harvest_job,
+                content=json.dumps(dataset),
+                extras=[HarvestObjectExtra(key=FINGERPRINT_EXTRA, value=fingerprint)],
+            )
+
+            obj.save()
+            self._gathered[guid] = obj
+            object_ids.append(obj.id)
+
+        return object_ids
+
+    def _update_object(self, obj, dataset, fingerprint):
+        # keep the name of the dataset, _set_unique_name has given it a new one
+        dataset["name"] = json.loads(obj.content)["name"]
+        obj.content = json.dumps(dataset)
+        for extra in obj.extras:
+            if extra.key == FINGERPRINT_EXTRA:
+                extra.value = fingerprint
+        obj.save()
+
+    def _set_unique_name(self, dataset):
+        if not dataset.get("name"):
+            dataset["name"] = self._gen_new_name(dataset["title"])
+        if dataset["name"] in self._names_taken:
+            suffix = (
+                len(
+                    [
+                        i
+                        for i in self._names_taken
+                        if i.startswith(dataset["name"] + "-")
+                    ]
+                )
+                + 1
+            )
+            dataset["name"] = "{}-{}".format(dataset["name"], suffix)
+        self._names_taken.append(dataset["name"])
+
+    def _get_fingerprint(self, dataset, harvest_job):
+        """
+        Fingerprint of a dataset as parsed from the source: its dct:modified and a
+        hash of the dataset dict, in which the profiles have put the dataset's
+        triples in a canonical form. The source config is part of the hash, as it
+        changes how datasets are imported.
+        """
+        content = json.dumps(
+            [harvest_job.source.config, dataset], sort_keys=True, default=str
+        )
+        return "{}|{}".format(
+            dataset.get("modified") or "",
+            hashlib.sha256(content.encode("utf8")).hexdigest(),
+        )
+
+    def _get_previous_fingerprints(self, harvest_job):
+        """
+        Return the fingerprints of the datasets that were imported successfully by
+        the previous jobs of the source, by guid. Datasets that have been deleted
+        since are left out, so that they are imported again.
+        """
+        query = (
+            model.Session.query(HarvestObject.guid, HarvestObjectExtra.value)
+            .join(
+                HarvestObjectExtra,
+                HarvestObjectExtra.harvest_object_id == HarvestObject.id,
+            )
+            .join(model.Package, model.Package.id == HarvestObject.package_id)
+            .filter(HarvestObject.harvest_source_id == harvest_job.source.id)
+            .filter(HarvestObject.current.is_(True))
+            .filter(HarvestObject.state == "COMPLETE")
+            .filter(HarvestObjectExtra.key == FINGERPRINT_EXTRA)
+            .filter(model.Package.state == "active")
+        )
+        return dict(query)
+
     def _get_guid(self, dataset_dict, source_url=None):
         """
         Try to get a unique identifier for a harvested dataset
@@ -46,3 +377,24 @@ class SwissDCATRDFHarvester(DCATRDFHarvester):
             return super(SwissDCATRDFHarvester, self)._gen_new_name(title["de"])
         except TypeError:
             return super(SwissDCATRDFHarvester, self)._gen_new_name(title)
+
+    def import_stage(self, harvest_object):
+        """
+        Same as in ckanext-dcat, but with at most "import_rate" datasets per second
+        imported by each fetch consumer, if it is set in the source config.
+        """
+        started = time.monotonic()
+        try:
+            return super(SwissDCATRDFHarvester, self).import_stage(harvest_object)
+        finally:
+            self._throttle_import(harvest_object, started)
+
+    def _throttle_import(self, harvest_object, started):
+        source_config = json.loads(harvest_object.job.source.config or "{}")
+        import_rate = source_config.get("import_rate")
+        if not import_rate:
+            return
+
+        wait = 1 / import_rate - (time.monotonic() - started)
+        if wait > 0:
+            time.sleep(wait)
@@ -0,0 +1,308 @@
+import hashlib
+import json
+import logging
+import sys
+from collections import defaultdict
+from xml.parsers import expat
+from xml.sax.saxutils import quoteattr
+
+import rdflib
+
+from ckanext.dcat.processors import RDFSerializer
+from ckanext.dcat.utils import url_to_rdflib_format
+from ckanext.switzerland.cache import LRUCache
+from ckanext.switzerland.dcat.profiles import DCAT
+
+log = logging.getLogger(__name__)
+
+# rdflib formats whose serialisations can be concatenated: every line of N-Triples
+# is a statement, and Turtle allows prefixes to be declared again. The node elements
+# of RDF/XML serialisations are moved into one rdf:RDF element, see
+# _iter_rdfxml_catalog.
+STREAMABLE_FORMATS = ("nt", "ntriples", "nt11", "turtle", "xml", "pretty-xml")
+RDFXML_FORMATS = ("xml", "pretty-xml")
+
+# rdflib formats with one statement per line, which can be split into the statements
+# about each dataset without parsing the whole document. Includes their media types,
+# as the gather stage may get the format from the Content-Type of the response.
+LINE_BASED_FORMATS = (
+    "nt",
+    "ntriples",
+    "nt11",
+    "nquads",
+    "application/n-triples",
+    "application/n-quads",
+)
+
+RDF_TYPE_TOKEN = "<{}>".format(rdflib.RDF.type)
+DCAT_DATASET_TOKEN = "<{}>".format(DCAT.Dataset)
+HYDRA_TOKEN_PREFIX = "<http://www.w3.org/ns/hydra/core#"
+
+# Serialised catalog fragments of datasets by (package id, rdflib format), for all
+# STREAMABLE_FORMATS. Each entry holds the metadata_modified of the dataset it was
+# serialised from and a digest of its organization, as editing an organization does
+# not change the metadata_modified of its datasets.
+dataset_fragments = LRUCache(maxsize=4096)
+
+
+class SwissRDFSerializer(RDFSerializer):
+    """
+    RDF serializer that builds the catalog dataset by dataset.
+
+    The RDFSerializer of ckanext-dcat adds all datasets to one graph and serialises
+    it at the end. For the formats in STREAMABLE_FORMATS, this serializer builds a
+    small graph for the catalog header and for each dataset, serialises it and
+    drops it before the next dataset is added. The serialised datasets are cached
+    until they are modified. Other formats (JSON-LD, N3) need the whole graph and
+    are serialised by RDFSerializer.
+    """
+
+    def serialize_catalog(
+        self, catalog_dict=None, dataset_dicts=None, _format="xml", pagination_info=None
+    ):
+        rdflib_format = url_to_rdflib_format(_format or "xml")
+        if rdflib_format not in STREAMABLE_FORMATS:
+            return super(SwissRDFSerializer, self).serialize_catalog(
+                catalog_dict, dataset_dicts, _format, pagination_info
+            )
+
+        return "".join(
+            self.iter_serialize_catalog(
+                catalog_dict, dataset_dicts, rdflib_format, pagination_info
+            )
+        )
+
+    def iter_serialize_catalog(
+        self, catalog_dict, dataset_dicts, rdflib_format, pagination_info=None
+    ):
+        """Yield the serialisation of the catalog in chunks: first the catalog
+        header and the pagination, then one chunk per dataset. The datasets are
+        serialised while the chunks are consumed.
+
+        rdflib_format must be one of STREAMABLE_FORMATS.
+        """
+        self.g = rdflib.Graph()
+        catalog_ref = self.graph_from_catalog(catalog_dict)
+        if pagination_info:
+            self._add_pagination_triples(pagination_info)
+        header = self.g.serialize(format=rdflib_format)
+        fragments = (
+            self._serialize_dataset_fragment(catalog_ref, dataset_dict, rdflib_format)
+            for dataset_dict in dataset_dicts or []
+        )
+
+        if rdflib_format in RDFXML_FORMATS:
+            yield from _iter_rdfxml_catalog(self.g, header, fragments)
+        else:
+            yield header
+            yield from fragments
+
+    def _serialize_dataset_fragment(self, catalog_ref, dataset_dict, rdflib_format):
+        """Serialise one dataset of the catalog, or get it from dataset_fragments if
+        the dataset has not been modified since it was serialised.
+        """
+        key = (dataset_dict.get("id"), rdflib_format)
+        version = (
+            dataset_dict.get("metadata_modified"),
+            _organization_digest(dataset_dict),
+            catalog_ref,
+            tuple(self._profiles),
+        )
+        cached = dataset_fragments.get(key)
+        if cached is not None and cached[0] == version and version[0] is not None:
+            return cached[1]
+
+        self.g = rdflib.Graph()
+        dataset_ref = self.graph_from_dataset(dataset_dict)
+        if not self._add_source_catalog(catalog_ref, dataset_dict, dataset_ref):
+            self.g.add((catalog_ref, DCAT.dataset, dataset_ref))
+        fragment = self.g.serialize(format=rdflib_format)
+        dataset_fragments.set(key, (version, fragment))
+        return fragment
+
+
+def _organization_digest(dataset_dict):
+    organization = json.dumps(
+        dataset_dict.get("organization"), sort_keys=True, default=str
+    )
+    return hashlib.sha1(organization.encode("utf8")).hexdigest()
+
+
+def _iter_rdfxml_catalog(header_graph, header, fragments):
+    """Yield one RDF/XML document containing the node elements of the header and
+    fragments documents.
+
+    The root element declares the namespaces bound in header_graph. Namespaces that
+    a fragment declares differently are declared again on its node elements.
+    """
+    namespaces = {
+        _xmlns_attribute(prefix): str(namespace)
+        for prefix, namespace in header_graph.namespaces()
+        if prefix != "xml"
+    }
+    yield '<?xml version="1.0" encoding="utf-8"?>\n<rdf:RDF\n'
+    for name, namespace in sorted(namespaces.items()):
+        yield "  {}={}\n".format(name, quoteattr(namespace))
+    yield ">"
+
+    yield _rdfxml_node_elements(header, namespaces)
+    for fragment in fragments:
+        yield _rdfxml_node_elements(fragment, namespaces)
+
+    yield "\n</rdf:RDF>\n"
+
+
+def _rdfxml_node_elements(document, namespaces):
+    """Return the node elements inside the rdf:RDF element of an RDF/XML document.
+
+    The namespace declarations of the rdf:RDF element that are not in namespaces
+    are added to each node element. The document is parsed to find the elements,
+    so that text content (e.g. CDATA sections) is not mistaken for markup.
+    """
+    data = document.encode("utf-8")
+    parser = expat.ParserCreate()
+    root_attributes = {}
+    # byte offsets and name lengths of the node elements, and the end of the body
+    node_elements = []
+    body_end = None
+    depth = 0
+
+    def start_element(name, attributes):
+        nonlocal depth
+        if depth == 0:
+            root_attributes.update(attributes)
+        elif depth == 1:
+            node_elements.append((parser.CurrentByteIndex, len(name.encode("utf-8"))))
+        depth += 1
+
+    def end_element(name):
+        nonlocal depth, body_end
+        depth -= 1
+        if depth == 0:
+            body_end = parser.CurrentByteIndex
+
+    parser.StartElementHandler = start_element
+    parser.EndElementHandler = end_element
+    parser.Parse(data, True)
+    if not node_elements:
+        return ""
+
+    declarations = "".join(
+        " {}={}".format(name, quoteattr(value))
+        for name, value in sorted(root_attributes.items())
+        if name.startswith("xmlns") and namespaces.get(name) != value
+    )
+    chunks = ["\n  "]
+    position = node_elements[0][0]
+    for start, name_length in node_elements:
+        # after "<" and the element name
+        insert_at = start + 1 + name_length
+        chunks.append(data[position:insert_at].decode("utf-8"))
+        chunks.append(declarations)
+        position = insert_at
+    chunks.append(data[position:body_end].decode("utf-8").rstrip())
+    return "".join(chunks)
+
+
+def _xmlns_attribute(prefix):
+    return "xmlns:{}".format(prefix) if prefix else "xmlns"
+
+
+def invalidate_dataset_fragments(package_id):
+    """Drop the cached catalog fragments of a dataset."""
+    for rdflib_format in STREAMABLE_FORMATS:
+        dataset_fragments.pop((package_id, rdflib_format))
+
+
+class LineBasedDatasetWindows(object):
+    """
+    Splits an N-Triples or N-Quads document into windows of a few datasets.
+
+    Each window holds the statements about window_size datasets and about all nodes
+    that can be reached from them (distributions, contact points, ...), without
+    following links to other datasets. It can be parsed into a graph of its own, so
+    that a harvester never has to hold the graph of the whole document.
+
+    Only the subject, predicate and object tokens of each line are looked at. The
+    statements about Hydra pagination nodes and the lines that can not be split are
+    put into the first window, the latter so that the RDF parser reports them.
+
+    The document itself is still needed to cut the windows from it, but it is not
+    copied: the statements of each node are indexed by the offsets of their lines,
+    and the node tokens are interned.
+    """
+
+    def __init__(self, content, window_size):
+        self.window_size = window_size
+        self.datasets = []
+        self._content = content
+        self._dataset_nodes = set()
+        self._statements = defaultdict(list)
+        self._links = defaultdict(list)
+        self._invalid = []
+        self._hydra_nodes = set()
+        start = 0
+        while start < len(content):
+            end = content.find("\n", start)
+            if end == -1:
+                end = len(content)
+            self._index_line(start, end)
+            start = end + 1
+
+    def _index_line(self, start, end):
+        line = self._content[start:end].strip()
+        if not line or line.startswith("#"):
+            return
+        parts = line.split(None, 2)
+        if len(parts) < 3:
+            self._invalid.append(start)
+            return
+
+        subject, predicate, rest = parts
+        subject = sys.intern(subject)
+        self._statements[subject].append(start)
+        obj = None
+        if rest[0] in "<_":
+            obj = sys.intern(rest.split(None, 1)[0])
+            self._links[subject].append(obj)
+        is_dataset = predicate == RDF_TYPE_TOKEN and obj == DCAT_DATASET_TOKEN
+        if is_dataset and subject not in self._dataset_nodes:
+            self._dataset_nodes.add(subject)
+            self.datasets.append(subject)
+        if predicate.startswith(HYDRA_TOKEN_PREFIX) or (
+            obj and obj.startswith(HYDRA_TOKEN_PREFIX)
+        ):
+            self._hydra_nodes.add(subject)
+
+    def __iter__(self):
+        """Yield the statements of each window as one string."""
+        for start in range(0, max(len(self.datasets), 1), self.window_size):
+            window = self.datasets[start : start + self.window_size]
+            offsets = self._first_window_statements() if start == 0 else []
+            offsets.extend(self._reachable_statements(window))
+            yield "\n".join(self._line_at(offset) for offset in offsets)
+
+    def _line_at(self, offset):
+        end = self._content.find("\n", offset)
+        return self._content[offset : end if end != -1 else None].strip()
+
+    def _reachable_statements(self, window):
+        offsets = []
+        seen = set(window)
+        queue = list(window)
+        while queue:
+            node = queue.pop()
+            offsets.extend(self._statements.get(node, []))
+            for obj in self._links.get(node, []):
+                if obj in self._statements and not (
+                    obj in seen or obj in self._dataset_nodes
+                ):
+                    seen.add(obj)
+                    queue.append(obj)
+        return offsets
+
+    def _first_window_statements(self):
+        offsets = list(self._invalid)
+        for node in self._hydra_nodes:
+            offsets.extend(self._statements[node])
+        return offsets
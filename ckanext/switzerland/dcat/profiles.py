@@ -66,6 +66,28 @@ class SwissDCATAPProfile(RDFProfile):
     It requires the European DCAT-AP profile (`euro_dcat_ap`)
     """
 
+    def __init__(self, *args, **kwargs):
+        super(SwissDCATAPProfile, self).__init__(*args, **kwargs)
+        # Objects of the graph by subject and predicate, see _objects
+        self._predicate_objects = {}
+
+    def _objects(self, subject, predicate):
+        """
+        Returns the objects of a subject and a predicate as a list
+
+        When parsing, the same subjects are looked up with many predicates. So the
+        first lookup of a subject gets all its predicates and objects from the graph
+        in one query and indexes them. The graph must not be changed after that,
+        which is the case when datasets are parsed.
+        """
+        objects_by_predicate = self._predicate_objects.get(subject)
+        if objects_by_predicate is None:
+            objects_by_predicate = {}
+            for p, o in self.g.predicate_objects(subject):
+                objects_by_predicate.setdefault(p, []).append(o)
+            self._predicate_objects[subject] = objects_by_predicate
+        return objects_by_predicate.get(predicate, [])
+
     def _object_value(self, subject, predicate, multilang=False):
         """
         Given a subject and a predicate, returns the value of the object
@@ -76,7 +98,7 @@ class SwissDCATAPProfile(RDFProfile):
         """
         default_lang = "de"
         lang_dict = {}
-        for o in self.g.objects(subject, predicate):
+        for o in self._objects(subject, predicate):
             if multilang and o.language:
                 lang_dict[o.language] = str(o)
             elif multilang:
@@ -94,7 +116,7 @@ class SwissDCATAPProfile(RDFProfile):
         """Overwritten from parent method to get name as multilang value."""
         publisher = {}
 
-        for agent in self.g.objects(subject, predicate):
+        for agent in self._objects(subject, predicate):
             publisher["uri"] = (
                 str(agent) if isinstance(agent, rdflib.term.URIRef) else ""
             )
@@ -108,7 +130,7 @@ class SwissDCATAPProfile(RDFProfile):
     def _relations(self, subject, predicate):
         relations = []
 
-        for relation_node in self.g.objects(subject, predicate):
+        for relation_node in self._objects(subject, predicate):
             relation = {
                 "label": self._object_value(relation_node, RDFS.label),
                 "url": relation_node,
@@ -123,7 +145,7 @@ class SwissDCATAPProfile(RDFProfile):
         for lang in get_langs():
             keywords[lang] = []
 
-        for keyword_node in self.g.objects(subject, predicate):
+        for keyword_node in self._objects(subject, predicate):
             keywords[keyword_node.language].append(str(keyword_node))
 
         return keywords
@@ -131,7 +153,7 @@ class SwissDCATAPProfile(RDFProfile):
     def _contact_points(self, subject, predicate):
         contact_points = []
 
-        for contact_node in self.g.objects(subject, predicate):
+        for contact_node in self._objects(subject, predicate):
             email = self._object_value(contact_node, VCARD.hasEmail)
             email_clean = email.replace("mailto:", "")
             contact = {
@@ -146,7 +168,7 @@ class SwissDCATAPProfile(RDFProfile):
     def _temporals(self, subject, predicate):
         temporals = []
 
-        for temporal_node in self.g.objects(subject, predicate):
+        for temporal_node in self._objects(subject, predicate):
             start_date = self._object_value(temporal_node, SCHEMA.startDate)
             end_date = self._object_value(temporal_node, SCHEMA.endDate)
             if start_date or end_date:
@@ -301,6 +323,14 @@ class SwissDCATAPProfile(RDFProfile):
         )
         dataset_dict["resources"].append(resource_dict)
 
+    def _object_value_list(self, subject, predicate):
+        """Overwritten from parent method to use the index of _objects."""
+        return [str(o) for o in self._objects(subject, predicate)]
+
+    def _distributions(self, dataset):
+        """Overwritten from parent method to use the index of _objects."""
+        return iter(self._objects(dataset, DCAT.distribution))
+
     def _multilingual_fields(self, subject, destination_dict):
         for key, predicate in (
             ("title", DCT.title),
@@ -542,9 +572,8 @@ class SwissDCATAPProfile(RDFProfile):
         if resource_dict["url_type"] == "upload":
             g.add((distribution, DCAT.downloadURL, URIRef(url)))
 
-            # Format from Download-Url
-            format_value = str(url).rsplit(".", 1)[1]
-            mapped_format = map_to_valid_format(format_value)
+            # Format from the file extension of the Download-Url
+            mapped_format = map_to_valid_format(str(url))
             g.add((distribution, DCT["format"], Literal(mapped_format)))
         # Mime-Type
         if resource_dict.get("mimetype"):
@@ -566,5 +595,12 @@ class SwissDCATAPProfile(RDFProfile):
             )
 
     def graph_from_catalog(self, catalog_dict, catalog_ref):
+        """Only add the catalog itself. The datasets are linked to it by the
+        serializer, see ckanext.switzerland.dcat.processors.
+        """
         g = self.g
+
+        for prefix, namespace in list(namespaces.items()):
+            g.bind(prefix, namespace)
+
         g.add((catalog_ref, RDF.type, DCAT.Catalog))
@@ -13,20 +13,18 @@ third stages (``HarvestObjectError``) are stored in the ``harvest_object_error``
 """
 
 import ftplib  # for errors only
-import io
+import hashlib
 import logging
-import mimetypes
 import os
 import re
 import shutil
 import time
 import traceback
-import zipfile
 from datetime import datetime
 
 import voluptuous
 from ckan import model
-from ckan.lib import helpers, search, uploader
+from ckan.lib import search, uploader
 from ckan.lib.helpers import json
 from ckan.lib.munge import munge_filename, munge_name
 from ckan.logic import NotFound, ValidationError, check_access, get_action
@@ -37,11 +35,17 @@ from werkzeug.datastructures import FileStorage
 
 from ckanext.harvest.harvesters.base import HarvesterBase
 from ckanext.harvest.model import HarvestObject
+from ckanext.switzerland.cache import LRUCache
+from ckanext.switzerland.harvester.formats import FetchSink, sniff_file
 from ckanext.switzerland.harvester.storage_adapter_factory import StorageAdapterFactory
 from ckanext.switzerland.helpers import get_default_licence_for_organization
 
 log = logging.getLogger(__name__)
 
+# Validated harvester configs by harvester class and hash of the config, see
+# BaseSBBHarvester.load_config
+harvester_configs = LRUCache(maxsize=128)
+
 
 def validate_regex(regex):
     try:
@@ -51,6 +55,28 @@ def validate_regex(regex):
     return regex
 
 
+class HarvesterConfig(dict):
+    """
+    The validated config of a harvest source.
+
+    Works like the dict returned by the validation schema, and also compiles the
+    regular expressions of the config (filter_regex, resource_regex, ...) once, so
+    that they are not compiled again for every file and resource.
+    """
+
+    def __init__(self, data):
+        super(HarvesterConfig, self).__init__(data)
+        self._patterns = {}
+
+    def pattern(self, key, flags=0):
+        """Return the compiled regular expression of the config value key."""
+        try:
+            return self._patterns[(key, flags)]
+        except KeyError:
+            pattern = self._patterns[(key, flags)] = re.compile(self[key], flags)
+            return pattern
+
+
 class BaseSBBHarvester(HarvesterBase):
     """
     A Base SBB Harvester for harvesting data from ftp/s3 aws server.
@@ -189,9 +215,20 @@ class BaseSBBHarvester(HarvesterBase):
         )
 
     def load_config(self, config_str):
-        schema = self.get_config_validation_schema()
-        data = json.loads(config_str)
-        return schema(data)
+        """
+        Validate the config of a harvest source and return it as a HarvesterConfig.
+
+        The configs are cached by harvester class and config, so that validating a
+        config when the source is saved and every stage of its harvest jobs use
+        the same config object and validate it only once.
+        """
+        key = (type(self).__name__, hashlib.sha1(config_str.encode("utf8")).hexdigest())
+        config = harvester_configs.get(key)
+        if config is None:
+            schema = self.get_config_validation_schema()
+            config = HarvesterConfig(schema(json.loads(config_str)))
+            harvester_configs.set(key, config)
+        return config
 
     # tested
     def _add_harvester_metadata(self, package_dict):
@@ -374,11 +411,19 @@ class BaseSBBHarvester(HarvesterBase):
     def _get_dataset(self, dataset):
         return get_action("ogdch_dataset_by_identifier")({}, {"identifier": dataset})
 
-    def _get_mimetypes(self, filename):
-        resource_formats = helpers.resource_formats()
-        guess, encoding = mimetypes.guess_type(filename, strict=False)
-
-        if guess is None or resource_formats.get(guess.lower()) is None:
+    def _get_mimetypes(self, filename, file_info=None):
+        if file_info and "format" in file_info:
+            # detected while the file was fetched
+            detected = None
+            if file_info["format"] is not None:
+                detected = (
+                    file_info["format"],
+                    file_info["mimetype"],
+                    file_info["mimetype_inner"],
+                )
+        else:
+            detected = sniff_file(filename)
+        if detected is None:
             log.info(
                 f"Couldn't get a valid resource format from the filename {filename}"
             )
@@ -388,36 +433,7 @@ class BaseSBBHarvester(HarvesterBase):
                 self.default_mimetype_inner,
             )
 
-        # format_info is a list, containing the following values:
-        # [
-        #     canonical mimetype lowercased,
-        #     canonical format (uppercase),
-        #     human readable form
-        # ]
-        format_info = resource_formats.get(guess.lower())
-
-        file_format = format_info[1]
-        mimetype = format_info[0]
-        mimetype_inner = None
-
-        if format_info[0] == "application/zip":
-            try:
-                zip_file = zipfile.ZipFile(filename)
-            except zipfile.BadZipFile:
-                log.warning(f"The file {filename} is not a valid zip file")
-                return file_format, mimetype, mimetype_inner
-
-            namelist = zip_file.namelist()
-
-            for name in namelist:
-                guess, encoding = mimetypes.guess_type(name, strict=False)
-                if guess is not None and resource_formats.get(guess.lower()):
-                    # We can only save one value to mimetype_inner, so once we get a
-                    # valid mimetype, we can stop looking
-                    mimetype_inner = guess
-                    break
-
-        return file_format, mimetype, mimetype_inner
+        return detected
 
     # =======================================================================
     # GATHER Stage
@@ -547,7 +563,11 @@ class BaseSBBHarvester(HarvesterBase):
                 log.info("Fetching file: %s" % str(f))
 
                 start = time.time()
-                status = storage.fetch(f, targetfile)  # 226 Transfer complete
+                # the sink collects the size, hash and format of the file while it
+                # is written, so that the import stage does not have to read it
+                with FetchSink(targetfile) as sink:
+                    # 226 Transfer complete
+                    status = storage.fetch(f, targetfile, sink=sink)
                 elapsed = time.time() - start
 
                 log.info("Fetched %s [%s] in %ds" % (f, str(status), elapsed))
@@ -584,6 +604,7 @@ class BaseSBBHarvester(HarvesterBase):
             "file": targetfile,
             "tmpfolder": tmpfolder,
             "dataset": obj["dataset"],
+            "file_info": sink.facts(),
         }
         if "filter" in obj:
             retobj["filter"] = obj["filter"]
@@ -664,6 +685,9 @@ class BaseSBBHarvester(HarvesterBase):
             return True
 
         if "filter" in obj:
+            # the filter writes a new file, the facts about the fetched one do not
+            # apply to it
+            obj.pop("file_info", None)
             file_filter = self.filters[obj["filter"]]
             obj = file_filter(obj, self.config)
 
@@ -854,12 +878,17 @@ class BaseSBBHarvester(HarvesterBase):
 
         log.info("Adding %s to package with id %s", str(filepath), dataset["id"])
 
+        # facts about the file collected while it was fetched
+        file_info = obj.get("file_info") or {}
+
         fp = None
         try:
-            try:
-                size = int(os.path.getsize(filepath))
-            except ValueError:
-                size = None
+            size = file_info.get("size")
+            if size is None:
+                try:
+                    size = int(os.path.getsize(filepath))
+                except ValueError:
+                    size = None
 
             fp = open(filepath, "rb")
 
@@ -880,11 +909,13 @@ class BaseSBBHarvester(HarvesterBase):
                         % str(old_resource_meta)
                     )
 
-            resource_meta = self.resource_dict_meta
+            resource_meta = dict(self.resource_dict_meta)
 
             resource_meta["identifier"] = file_name
 
-            file_format, mimetype, mimetype_inner = self._get_mimetypes(filepath)
+            file_format, mimetype, mimetype_inner = self._get_mimetypes(
+                filepath, file_info
+            )
             resource_meta["format"] = file_format
             resource_meta["media_type"] = mimetype
             resource_meta["mimetype"] = mimetype
@@ -933,12 +964,15 @@ class BaseSBBHarvester(HarvesterBase):
                 resource_meta["size"] = size
                 resource_meta["byte_size"] = size
 
-            log.info("Creating new resource: %s" % str(resource_meta))
+            if file_info.get("sha256"):
+                resource_meta["hash"] = file_info["sha256"]
+            else:
+                resource_meta.pop("hash", None)
 
-            with open(filepath, "rb") as f:
-                stream = io.BytesIO(f.read())
+            log.info("Creating new resource: %s" % str(resource_meta))
 
-            upload = FileStorage(stream=stream, filename=file_name)
+            # the uploader copies the file from the open file pointer
+            upload = FileStorage(stream=fp, filename=file_name)
 
             resource_meta["upload"] = upload
             resource_meta["modified"] = now
@@ -989,18 +1023,17 @@ class BaseSBBHarvester(HarvesterBase):
 
         # get filename regex for permalink from harvester config or fallback to a
         # catch-all
-        identifier_regex = self.config["resource_regex"]
+        identifier_regex = self.config.pattern("resource_regex", re.IGNORECASE)
         for resource in package["resources"]:
-            if re.match(identifier_regex, resource["identifier"], re.IGNORECASE):
+            if identifier_regex.match(resource["identifier"]):
                 ordered_resources.append(resource)
             else:
                 unmatched_resources.append(resource)
 
         if self.config["date_pattern"]:
+            date_pattern = self.config.pattern("date_pattern")
             ordered_resources.sort(
-                key=lambda r: re.search(
-                    self.config["date_pattern"], r["identifier"]
-                ).group(),
+                key=lambda r: date_pattern.search(r["identifier"]).group(),
                 reverse=True,
             )
         else:
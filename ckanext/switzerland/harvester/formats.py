@@ -0,0 +1,263 @@
+"""
+Detection of the format of harvested files.
+
+The format is guessed from the filename and, if that fails, from the magic number
+at the start of the file. The inner mimetype of zip files is guessed from the
+member names in the central directory, which is read without reading the members.
+Both can be collected while a file is downloaded (see FormatSniffer and FetchSink),
+so that the file does not have to be opened again to detect its format. The members
+found in the central directory can be read one by one (see open_zip_member).
+"""
+
+import hashlib
+import io
+import logging
+import os
+import struct
+import zipfile
+
+from ckan.lib import helpers
+
+from ckanext.switzerland.helpers import guess_media_type
+
+log = logging.getLogger(__name__)
+
+# Number of bytes at the start of a file that are kept to detect its format
+SNIFF_SIZE = 4096
+
+# Number of bytes at the end of a zip file that are kept while it is downloaded. The
+# end of central directory record is at most 22 bytes plus a 64 KiB comment from
+# the end, and the central directory is right before it.
+ZIP_TAIL_SIZE = 1024 * 1024
+
+# Maximum number of zip member names that are stored in the facts about a fetched
+# file, so that the harvest object content stays small for zip files with many
+# members
+ZIP_MEMBER_NAMES_LIMIT = 1000
+
+MAGIC_NUMBERS = (
+    (b"PK\x03\x04", "application/zip"),
+    (b"PK\x05\x06", "application/zip"),
+    (b"\x1f\x8b", "application/gzip"),
+    (b"%PDF-", "application/pdf"),
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"<?xml", "application/xml"),
+)
+
+
+def sniff_mimetype(head):
+    """Return the mimetype for the magic number at the start of head, or None."""
+    for magic, mimetype in MAGIC_NUMBERS:
+        if head.startswith(magic):
+            return mimetype
+    return None
+
+
+def detect_format(filename, head=b"", zip_members=None):
+    """
+    Return the format, mimetype and inner mimetype of a file, or None if neither its
+    name nor its first bytes (head) match a format in ckan's resource formats.
+
+    The inner mimetype of zip files is guessed from the names of zip_members.
+    """
+    # resource_formats() is loaded once per process, and maps lower-cased
+    # mimetypes, format names and alternative names to the format
+    resource_formats = helpers.resource_formats()
+
+    format_info = None
+    for guess in (guess_media_type(filename), sniff_mimetype(head)):
+        if guess is not None and resource_formats.get(guess.lower()):
+            # format_info is a list: [canonical mimetype lowercased, canonical
+            # format (uppercase), human readable form]
+            format_info = resource_formats[guess.lower()]
+            break
+    if format_info is None:
+        return None
+
+    mimetype_inner = None
+    if format_info[0] == "application/zip":
+        if zip_members is None:
+            log.warning(f"The file {filename} is not a valid zip file")
+        for member in zip_members or []:
+            guess = guess_media_type(member.filename)
+            if guess is not None and resource_formats.get(guess.lower()):
+                # We can only save one value to mimetype_inner, so once we get a
+                # valid mimetype, we can stop looking
+                mimetype_inner = guess
+                break
+
+    return format_info[1], format_info[0], mimetype_inner
+
+
+def sniff_file(path):
+    """
+    Detect the format of a file on disk (see detect_format), reading only its first
+    bytes and, for zip files, its central directory.
+    """
+    with open(path, "rb") as f:
+        head = f.read(SNIFF_SIZE)
+        zip_members = read_zip_members(f) if head.startswith(b"PK") else None
+    return detect_format(path, head, zip_members)
+
+
+def read_zip_members(f):
+    """
+    Return the members (zipfile.ZipInfo) of the zip file f (a seekable binary file)
+    from its central directory, or None if f is not a valid zip file.
+    """
+    try:
+        with zipfile.ZipFile(f) as zip_file:
+            return zip_file.infolist()
+    except zipfile.BadZipFile:
+        return None
+
+
+def open_zip_member(f, member):
+    """
+    Return a file object with the uncompressed content of member (see
+    read_zip_members) of the zip file f, without reading the central directory
+    again. The member is decompressed while the file object is read, and f must not
+    be used meanwhile.
+
+    Raises zipfile.BadZipFile if the local header of the member is invalid,
+    RuntimeError if the member is encrypted and NotImplementedError if its
+    compression method is not supported.
+    """
+    f.seek(member.header_offset)
+    header = f.read(zipfile.sizeFileHeader)
+    if len(header) < zipfile.sizeFileHeader or not header.startswith(
+        zipfile.stringFileHeader
+    ):
+        raise zipfile.BadZipFile(
+            f"Invalid local header for zip member {member.filename}"
+        )
+    # Bit 0 of the flags is set if the member is encrypted
+    if member.flag_bits & 0x1:
+        raise RuntimeError(f"The zip member {member.filename} is encrypted")
+
+    # The local extra field (e.g. the zip64 sizes) is skipped, the sizes of member
+    # are already read from the central directory
+    *_, name_length, extra_length = struct.unpack(zipfile.structFileHeader, header)
+    f.seek(name_length + extra_length, os.SEEK_CUR)
+    return zipfile.ZipExtFile(f, "r", member)
+
+
+def zip_members_from_tail(tail):
+    """
+    Return the members of a zip file from the last bytes of the file, or None if the
+    central directory is not contained in them.
+    """
+    # zipfile finds the central directory relative to its end record, as it does
+    # for zip files with data prepended to them
+    return read_zip_members(io.BytesIO(tail))
+
+
+class FormatSniffer(object):
+    """
+    Collects what is needed to detect the format of a file while it is written:
+    its first bytes and, for zip files, its last bytes, which contain the central
+    directory.
+
+    Call update with each chunk of the file, then result.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.head = b""
+        self._tail = bytearray()
+        self._is_zip = None
+
+    def update(self, chunk):
+        if len(self.head) < SNIFF_SIZE:
+            self.head += chunk[: SNIFF_SIZE - len(self.head)]
+        if self._is_zip is None and len(self.head) >= 4:
+            self._is_zip = self.head.startswith(b"PK")
+        if self._is_zip is False:
+            return
+
+        self._tail += chunk
+        if len(self._tail) > 2 * ZIP_TAIL_SIZE:
+            del self._tail[:-ZIP_TAIL_SIZE]
+
+    @property
+    def is_zip(self):
+        return bool(self._is_zip)
+
+    @property
+    def zip_members(self):
+        if not self._is_zip:
+            return None
+        return zip_members_from_tail(self._tail)
+
+    def result(self):
+        """Return the format, mimetype and inner mimetype, see detect_format."""
+        return detect_format(self.filename, self.head, self.zip_members)
+
+
+class FetchSink(object):
+    """
+    Writes a downloaded file to path and collects facts about it on the way: its
+    size, SHA-256 hash, format and, for zip files, the names of its members.
+
+    Storage adapters call write with each chunk of the file, in order. Use it as a
+    context manager, then get the facts with facts.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.size = 0
+        self._file = None
+        self._sha256 = hashlib.sha256()
+        self._sniffer = FormatSniffer(path)
+
+    def __enter__(self):
+        # The working directory of the harvest object may be missing, e.g. if the
+        # file is fetched on another host than the one that gathered it
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._file = open(self.path, "wb")
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._file.close()
+
+    def write(self, chunk):
+        self._file.write(chunk)
+        self.size += len(chunk)
+        self._sha256.update(chunk)
+        self._sniffer.update(chunk)
+        return len(chunk)
+
+    def facts(self):
+        """
+        Return the facts about the written file as a json-serialisable dict. format,
+        mimetype and mimetype_inner are None if the format could not be detected.
+        zip_members holds the names of at most ZIP_MEMBER_NAMES_LIMIT members, and
+        is None if the file is not a valid zip file.
+        """
+        zip_members = self._sniffer.zip_members
+        if self._sniffer.is_zip and zip_members is None:
+            # The central directory is not in the kept tail of the file (e.g. it
+            # is larger than ZIP_TAIL_SIZE), so it is read from the written file
+            log.info(
+                f"The central directory of {self.path} is not in the last "
+                f"{ZIP_TAIL_SIZE} bytes, reading it from the file"
+            )
+            with open(self.path, "rb") as f:
+                zip_members = read_zip_members(f)
+        detected = detect_format(self.path, self._sniffer.head, zip_members)
+        file_format, mimetype, mimetype_inner = detected or (None, None, None)
+        return {
+            "size": self.size,
+            "sha256": self._sha256.hexdigest(),
+            "format": file_format,
+            "mimetype": mimetype,
+            "mimetype_inner": mimetype_inner,
+            "zip_members": (
+                None
+                if zip_members is None
+                else [m.filename for m in zip_members[:ZIP_MEMBER_NAMES_LIMIT]]
+            ),
+        }
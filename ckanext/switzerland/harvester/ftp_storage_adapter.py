@@ -301,7 +301,7 @@ class FTPStorageAdapter(StorageAdapterBase):
         return modified_date
 
     # tested
-    def fetch(self, filename, localpath=None):
+    def fetch(self, filename, localpath=None, sink=None):
         """
         Fetch a single file from the remote server with ftplib and pysftp
 
@@ -309,6 +309,9 @@ class FTPStorageAdapter(StorageAdapterBase):
         :type filename: str or unicode
         :param localpath: Local folder to store the file
         :type localpath: str or unicode
+        :param sink: Writable file-like object that gets the file in order, chunk by
+            chunk, instead of localpath (e.g. a FetchSink)
+        :type sink: object
 
         :returns: Status of the FTP operation
         :rtype: string
@@ -316,13 +319,19 @@ class FTPStorageAdapter(StorageAdapterBase):
         if not localpath:
             localpath = os.path.join(self._config[LOCAL_PATH], filename)
 
-        localfile = open(localpath, "wb")
+        localfile = sink or open(localpath, "wb")
 
         if self.ftps:
             status = self.ftps.retrbinary("RETR %s" % filename, localfile.write)
-            localfile.close()
+            if sink is None:
+                localfile.close()
         elif self.sftp:
-            status = self.sftp.get(filename, localpath=localpath)
+            if sink is None:
+                status = self.sftp.get(filename, localpath=localpath)
+            else:
+                # getfo returns the number of bytes transferred
+                self.sftp.getfo(filename, sink)
+                status = None
 
             if status is None:
                 status = "226 Transfer complete"
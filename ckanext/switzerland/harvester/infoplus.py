@@ -1,7 +1,6 @@
 import json
 import logging
 import os
-import re
 from zipfile import ZipFile
 
 import unicodecsv
@@ -42,11 +41,13 @@ def get_filename(filelist_with_dataset, harvester_config):
     """
     Get the file from which we should extract and convert the infoplus files
     """
+    timetable_regex = harvester_config.pattern("timetable_regex")
+    resource_regex = harvester_config.pattern("resource_regex")
     files = []
     for filename, dataset in filelist_with_dataset:
-        year = int(re.match(harvester_config["timetable_regex"], filename).group(1))
+        year = int(timetable_regex.match(filename).group(1))
         if year == harvester_config["infoplus"]["year"]:
-            if re.match(harvester_config["resource_regex"], filename):
+            if resource_regex.match(filename):
                 files.append(filename)
 
     if not files:
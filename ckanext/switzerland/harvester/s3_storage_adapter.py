@@ -13,7 +13,6 @@ The class is intended to be used with Python's `with` statement, e.g.
 import datetime
 import logging
 import os
-import re
 
 import boto3
 import boto3.session
@@ -191,20 +190,22 @@ class S3StorageAdapter(StorageAdapterBase):
         except ClientError:
             return None
 
-    def fetch(self, filename, localpath=None):
+    def fetch(self, filename, localpath=None, sink=None):
         prefix = self.__determine_prefix__(None)
         file_full_path = os.path.join(prefix, filename)
 
         if not localpath:
             localpath = os.path.join(self._config[LOCAL_PATH], filename)
 
-        # ensure that the local path is a valid director
-        local_tmp_path = re.match(r"(.*)/[^/]+$", localpath).group(1)
-        if not os.path.exists(local_tmp_path):
-            os.makedirs(local_tmp_path)
-
-        self._aws_client.download_file(
-            self._config[AWS_BUCKET_NAME], file_full_path, localpath
-        )
+        if sink is None:
+            self._aws_client.download_file(
+                self._config[AWS_BUCKET_NAME], file_full_path, localpath
+            )
+        else:
+            # The sink has no seek method, so the parts of the file are written to
+            # it in order
+            self._aws_client.download_fileobj(
+                self._config[AWS_BUCKET_NAME], file_full_path, sink
+            )
 
         return "226 Transfer complete"
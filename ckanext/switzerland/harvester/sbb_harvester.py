@@ -1,7 +1,6 @@
 import ftplib  # for errors only
 import logging
 import os
-import re
 import tempfile
 import traceback
 from datetime import datetime
@@ -90,7 +89,7 @@ class SBBHarvester(BaseSBBHarvester):
                     [
                         filename
                         for filename in filelist
-                        if re.match(self.config["filter_regex"], filename)
+                        if self.config.pattern("filter_regex").match(filename)
                     ]
                 )
 
@@ -263,7 +263,7 @@ class StorageAdapterBase(object):
         num_files = len(self.get_remote_dirlist_all(folder))
         return num_files
 
-    def fetch(self, filename, localpath=None):
+    def fetch(self, filename, localpath=None, sink=None):
         """
         Fetch a single file from the remote server
 
@@ -271,6 +271,9 @@ class StorageAdapterBase(object):
         :type filename: str or unicode
         :param localpath: Local folder to store the file
         :type localpath: str or unicode
+        :param sink: Writable file-like object that gets the file in order, chunk by
+            chunk, instead of localpath (e.g. a FetchSink)
+        :type sink: object
 
         :returns: Status of the operation
         :rtype: string
@@ -1,7 +1,6 @@
 import ftplib  # for errors only
 import logging
 import os
-import re
 import tempfile
 import traceback
 from datetime import datetime
@@ -91,7 +90,7 @@ class TimetableHarvester(SBBHarvester):
                 filelist = [
                     filename
                     for filename in filelist
-                    if re.match(self.config["filter_regex"], filename)
+                    if self.config.pattern("filter_regex").match(filename)
                 ]
 
                 # get last-modified date of each file
@@ -139,7 +138,7 @@ class TimetableHarvester(SBBHarvester):
 
         filelist_with_dataset = []
         for filename in filelist:
-            match = re.match(self.config["timetable_regex"], filename)
+            match = self.config.pattern("timetable_regex").match(filename)
             if match:
                 dataset = self.config["dataset"].format(year=match.group(1))
                 filelist_with_dataset.append((filename, dataset))
@@ -171,36 +170,23 @@ class TimetableHarvester(SBBHarvester):
 
             if not force_all:
                 # Request only the resources modified since last harvest job
-                for f in filelist_with_dataset[:]:
-                    filename, dataset = f
-                    modified_date = modified_dates.get(filename)
-
-                    try:
-                        existing_dataset = self._get_dataset(dataset)
-                    except NotFound:
-                        continue  # dataset for this year does not exist yet
-                    package = model.Package.get(existing_dataset["id"])
-                    existing_resources = [
-                        os.path.basename(r.url) for r in package.resources_all
-                    ]
-
-                    log.info(
-                        "Existing resources on dataset with id {}: {}".format(
-                            existing_dataset["id"], existing_resources
-                        )
-                    )
+                existing_filenames = self._get_existing_filenames(
+                    set(map(itemgetter(1), filelist_with_dataset))
+                )
 
-                    # skip file if its older than last harvester run date and it
-                    # actually exists on the dataset
-                    # only skip when file was already downloaded once
-                    if (
-                        modified_date
-                        and modified_date < previous_job.gather_started
+                # skip file if its older than last harvester run date and it
+                # actually exists on the dataset
+                # only skip when file was already downloaded once
+                filelist_with_dataset = [
+                    (filename, dataset)
+                    for filename, dataset in filelist_with_dataset
+                    if not (
+                        modified_dates.get(filename)
+                        and modified_dates[filename] < previous_job.gather_started
                         and munge_filename(os.path.basename(filename))
-                        in existing_resources
-                    ):
-                        # do not run the harvest for this file
-                        filelist_with_dataset.remove(f)
+                        in existing_filenames[dataset]
+                    )
+                ]
 
                 if not len(filelist_with_dataset):
                     log.info(
@@ -270,3 +256,32 @@ class TimetableHarvester(SBBHarvester):
         # ------------------------------------------------------
         # send the jobs to the gather queue
         return object_ids
+
+    def _get_existing_filenames(self, datasets):
+        """
+        Return the filenames of all resources, including deleted ones, of each of the
+        given datasets. The filenames are empty for datasets that do not exist yet.
+
+        The resource urls of uploaded files are their munged filenames.
+        """
+        existing_filenames = {}
+        for dataset in datasets:
+            try:
+                existing_dataset = self._get_dataset(dataset)
+            except NotFound:
+                existing_filenames[dataset] = set()
+                continue  # dataset for this year does not exist yet
+
+            existing_filenames[dataset] = {
+                os.path.basename(url)
+                for (url,) in Session.query(model.Resource.url).filter(
+                    model.Resource.package_id == existing_dataset["id"]
+                )
+            }
+            log.info(
+                "Existing resources on dataset with id {}: {}".format(
+                    existing_dataset["id"], len(existing_filenames[dataset])
+                )
+            )
+
+        return existing_filenames
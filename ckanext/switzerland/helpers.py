@@ -1,6 +1,7 @@
 import ast
 import json
 import logging
+import mimetypes
 import os
 import unicodedata
 from collections import OrderedDict, defaultdict
@@ -15,6 +16,14 @@ from ckan.lib.helpers import dataset_display_name as dataset_display_name_orig
 from ckan.lib.helpers import organization_link as organization_link_orig
 from ckan.lib.helpers import url_for
 from ckan.lib.munge import munge_filename, munge_title_to_name
+from flask_babel import get_locale, get_translations
+
+from ckanext.switzerland.cache import LRUCache
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 log = logging.getLogger(__name__)
 
@@ -29,10 +38,134 @@ DATETIME_FIELDS = [
 ]
 UTC = ZoneInfo("UTC")
 ZURICH = ZoneInfo("Europe/Zurich")
+MEDIA_TYPE_CHOICES = [
+    {"label": media_type, "value": media_type}
+    for media_type in [
+        "application/gzip",
+        "application/json",
+        "application/protobuf",
+        "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+        "application/xml",
+        "application/zip",
+        "text/csv",
+    ]
+]
 TERMS_OF_USE_OPEN = "http://dcat-ap.ch/vocabulary/licenses/terms_open"
 TERMS_OF_USE_BY = "http://dcat-ap.ch/vocabulary/licenses/terms_by"
 TERMS_OF_USE_ASK = "http://dcat-ap.ch/vocabulary/licenses/terms_ask"
 TERMS_OF_USE_BY_ASK = "http://dcat-ap.ch/vocabulary/licenses/terms_by_ask"
+OPEN_TERMS_OF_USE = frozenset(
+    [
+        "NonCommercialAllowed-CommercialAllowed-ReferenceNotRequired",
+        "NonCommercialAllowed-CommercialAllowed-ReferenceRequired",
+        "NonCommercialAllowed-CommercialWithPermission-ReferenceNotRequired",
+        "NonCommercialAllowed-CommercialWithPermission-ReferenceRequired",
+    ]
+)
+
+# Valid DCAT-AP file types, each with the lowercase format names and file extensions
+# and the mimetypes that map to it. The first mimetype is the canonical one.
+VALID_FORMATS = {
+    "http://publications.europa.eu/resource/authority/file-type/CSV": (
+        ["csv"],
+        ["text/csv"],
+    ),
+    "http://publications.europa.eu/resource/authority/file-type/GEOJSON": (
+        ["geojson"],
+        ["application/geo+json"],
+    ),
+    "http://publications.europa.eu/resource/authority/file-type/GEOTIFF": (
+        ["geotiff"],
+        [],
+    ),
+    "http://publications.europa.eu/resource/authority/file-type/GPKG": (
+        ["gpkg"],
+        ["application/geopackage+sqlite3"],
+    ),
+    "http://publications.europa.eu/resource/authority/file-type/HTML": (
+        ["html", "htm"],
+        ["text/html"],
+    ),
+    "http://publications.europa.eu/resource/authority/file-type/JSON": (
+        ["json"],
+        ["application/json"],
+    ),
+    "http://publications.europa.eu/resource/authority/file-type/KMZ": (
+        ["kmz"],
+        ["application/vnd.google-earth.kmz+xml", "application/vnd.google-earth.kmz"],
+    ),
+    "http://publications.europa.eu/resource/authority/file-type/ODS": (
+        ["ods"],
+        ["application/vnd.oasis.opendocument.spreadsheet"],
+    ),
+    "http://publications.europa.eu/resource/authority/file-type/PDF": (
+        ["pdf"],
+        ["application/pdf"],
+    ),
+    "http://publications.europa.eu/resource/authority/file-type/PNG": (
+        ["png"],
+        ["image/png"],
+    ),
+    "http://publications.europa.eu/resource/authority/file-type/RDF": (
+        ["sparql-..."],
+        ["application/rdf+xml"],
+    ),
+    "http://publications.europa.eu/resource/authority/file-type/TXT": (
+        ["text", "txt", "text (.txt)", "plain"],
+        ["text/plain"],
+    ),
+    "http://publications.europa.eu/resource/authority/file-type/TIFF": (
+        ["tiff", "tif"],
+        ["image/tiff"],
+    ),
+    "http://publications.europa.eu/resource/authority/file-type/WCS_SRVC": (
+        ["wcs"],
+        [],
+    ),
+    "http://publications.europa.eu/resource/authority/file-type/WFS_SRVC": (
+        ["wfs"],
+        [],
+    ),
+    "http://publications.europa.eu/resource/authority/file-type/WMS_SRVC": (
+        ["wms"],
+        [],
+    ),
+    "http://publications.europa.eu/resource/authority/file-type/WMTS_SRVC": (
+        ["wmts"],
+        [],
+    ),
+    "http://publications.europa.eu/resource/authority/file-type/XLS": (
+        ["xls", "xlsx"],
+        [
+            "application/vnd.ms-excel",
+            "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+        ],
+    ),
+    "http://publications.europa.eu/resource/authority/file-type/XML": (
+        ["xml"],
+        ["application/xml", "text/xml"],
+    ),
+    "http://publications.europa.eu/resource/authority/file-type/ZIP": (
+        ["zip", "gz"],
+        ["application/zip", "application/gzip", "application/x-zip-compressed"],
+    ),
+}
+# Inverted index of VALID_FORMATS: format names, extensions and mimetypes to URIs
+VALID_FORMAT_INDEX = {
+    value: uri
+    for uri, (names, media_types) in VALID_FORMATS.items()
+    for value in names + media_types
+}
+# Canonical mimetype of each valid format
+VALID_FORMAT_MEDIA_TYPES = {
+    uri: media_types[0]
+    for uri, (names, media_types) in VALID_FORMATS.items()
+    if media_types
+}
+
+# Translated names of choice lists and their reverse index by (name, locale), see
+# _get_translated_names
+translated_names = LRUCache(maxsize=64)
 
 
 def get_langs():
@@ -83,18 +216,7 @@ def _lang_fallback(lang_dict, default_value):
 
 
 def ogdch_get_media_type_choices(field):
-    return [
-        {"label": "application/gzip", "value": "application/gzip"},
-        {"label": "application/json", "value": "application/json"},
-        {"label": "application/protobuf", "value": "application/protobuf"},
-        {
-            "label": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-            "value": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-        },
-        {"label": "application/xml", "value": "application/xml"},
-        {"label": "application/zip", "value": "application/zip"},
-        {"label": "text/csv", "value": "text/csv"},
-    ]
+    return [dict(choice) for choice in MEDIA_TYPE_CHOICES]
 
 
 def get_default_licence_for_organization(org_dict):
@@ -104,44 +226,75 @@ def get_default_licence_for_organization(org_dict):
 
 
 def ogdch_get_accrual_periodicity_choices(field):
-    map = [
-        {"label": label, "value": value}
-        for value, label in get_frequency_name(get_map=True).items()
-    ]
-    return map
+    names, _uris = _get_translated_names("frequency", _frequency_names)
+    return _get_choices(names)
 
 
 def ogdch_get_license_choices(field):
-    return [
-        {
-            "label": _(
-                "Non-commercial Allowed / Commercial Allowed / Reference Not Required"
+    names, _uris = _get_translated_names("license", _license_names)
+    return _get_choices(names)
+
+
+def _get_choices(names):
+    """Get the choices for a scheming select field from an OrderedDict of URIs and
+    names. The list is built on every call, so that callers can change it.
+    """
+    return [{"label": label, "value": uri} for uri, label in names.items()]
+
+
+def _license_names():
+    return OrderedDict(
+        [
+            (
+                TERMS_OF_USE_OPEN,
+                _(
+                    "Non-commercial Allowed / Commercial Allowed / Reference Not Required"
+                ),
             ),
-            "value": TERMS_OF_USE_OPEN,
-        },
-        {
-            "label": _(
-                "Non-commercial Allowed / Commercial With Permission Allowed / Reference Not Required"
+            (
+                TERMS_OF_USE_ASK,
+                _(
+                    "Non-commercial Allowed / Commercial With Permission Allowed / Reference Not Required"
+                ),
             ),
-            "value": TERMS_OF_USE_ASK,
-        },
-        {
-            "label": _(
-                "Non-commercial Allowed / Commercial With Permission Allowed / Reference Required"
+            (
+                TERMS_OF_USE_BY_ASK,
+                _(
+                    "Non-commercial Allowed / Commercial With Permission Allowed / Reference Required"
+                ),
             ),
-            "value": TERMS_OF_USE_BY_ASK,
-        },
-        {
-            "label": _(
-                "Non-commercial Allowed / Commercial Allowed / Reference Required"
+            (
+                TERMS_OF_USE_BY,
+                _("Non-commercial Allowed / Commercial Allowed / Reference Required"),
             ),
-            "value": TERMS_OF_USE_BY,
-        },
-    ]
+        ]
+    )
 
 
 def get_frequency_name(identifier=None, get_map=False):
-    frequencies = OrderedDict(
+    frequencies, _uris = _get_translated_names("frequency", _frequency_names)
+    if get_map:
+        # a copy, so that callers can not change the cached names
+        return OrderedDict(frequencies)
+    try:
+        return frequencies[identifier]
+    except (KeyError, TypeError):
+        return identifier
+
+
+def get_frequency_uri(name):
+    """Get the frequency URI for a frequency name in the current language, or the
+    name itself if it is not a known frequency name.
+    """
+    _names, uris = _get_translated_names("frequency", _frequency_names)
+    try:
+        return uris[name]
+    except (KeyError, TypeError):
+        return name
+
+
+def _frequency_names():
+    return OrderedDict(
         [
             (
                 "http://publications.europa.eu/resource/authority/frequency/IRREG",
@@ -221,23 +374,34 @@ def get_frequency_name(identifier=None, get_map=False):
             ),
         ]
     )
-    if get_map:
-        return frequencies
-    try:
-        return frequencies[identifier]
-    except KeyError:
-        return identifier
 
 
-def simplify_terms_of_use(term_id):
-    terms = [
-        "NonCommercialAllowed-CommercialAllowed-ReferenceNotRequired",
-        "NonCommercialAllowed-CommercialAllowed-ReferenceRequired",
-        "NonCommercialAllowed-CommercialWithPermission-ReferenceNotRequired",
-        "NonCommercialAllowed-CommercialWithPermission-ReferenceRequired",
-    ]
+def _get_translated_names(name, get_names):
+    """Get the translated names of a choice list in the current language, and the
+    reverse index of names and URIs.
 
-    if term_id in terms:
+    get_names returns an OrderedDict of URIs and translated names. The names and
+    the reverse index built from them are cached per language together with the
+    translations object that was used. Flask-Babel creates a new translations
+    object when it loads the translations again, and then the cache entry is
+    rebuilt.
+
+    The cached dicts are shared between requests and must not be changed.
+    """
+    translations = get_translations()
+    key = (name, str(get_locale()))
+    cached = translated_names.get(key)
+    if cached is not None and cached[0] is translations:
+        return cached[1], cached[2]
+
+    names = get_names()
+    uris = {label: uri for uri, label in names.items()}
+    translated_names.set(key, (translations, names, uris))
+    return names, uris
+
+
+def simplify_terms_of_use(term_id):
+    if term_id in OPEN_TERMS_OF_USE:
         return term_id
     return "ClosedData"
 
@@ -270,6 +434,24 @@ def parse_json(value, default_value=None):
         return value
 
 
+def json_loads(value):
+    """Parse a json string, using orjson if it is installed."""
+    if orjson is not None:
+        return orjson.loads(value)
+    return json.loads(value)
+
+
+def json_dumps(value):
+    """Serialise a value to a json string, using orjson if it is installed."""
+    if orjson is not None:
+        try:
+            return orjson.dumps(value).decode("utf-8")
+        except TypeError:
+            # orjson is stricter than json, e.g. about non-string dict keys
+            pass
+    return json.dumps(value)
+
+
 def get_content_headers(url):
     response = requests.head(url)
     return response
@@ -365,52 +547,31 @@ def resource_filename(resource_url):
 
 # all formats that need to be mapped have to be entered lower-case
 def map_to_valid_format(resource_format):
-    format_mapping = {
-        "http://publications.europa.eu/resource/authority/file-type/CSV": ["csv"],
-        "http://publications.europa.eu/resource/authority/file-type/GEOJSON": [
-            "geojson"
-        ],
-        "http://publications.europa.eu/resource/authority/file-type/GEOTIFF": [
-            "geotiff"
-        ],
-        "http://publications.europa.eu/resource/authority/file-type/GPKG": ["gpkg"],
-        "http://publications.europa.eu/resource/authority/file-type/HTML": ["html"],
-        "http://publications.europa.eu/resource/authority/file-type/JSON": ["json"],
-        "http://publications.europa.eu/resource/authority/file-type/KMZ": ["kmz"],
-        "http://publications.europa.eu/resource/authority/file-type/ODS": ["ods"],
-        "http://publications.europa.eu/resource/authority/file-type/PDF": ["pdf"],
-        "http://publications.europa.eu/resource/authority/file-type/PNG": ["png"],
-        "http://publications.europa.eu/resource/authority/file-type/RDF": [
-            "sparql-..."
-        ],
-        "http://publications.europa.eu/resource/authority/file-type/TXT": [
-            "text",
-            "txt",
-            "text (.txt)",
-            "plain",
-        ],
-        "http://publications.europa.eu/resource/authority/file-type/TIFF": ["tiff"],
-        "http://publications.europa.eu/resource/authority/file-type/WCS_SRVC": ["wcs"],
-        "http://publications.europa.eu/resource/authority/file-type/WFS_SRVC": ["wfs"],
-        "http://publications.europa.eu/resource/authority/file-type/WMS_SRVC": ["wms"],
-        "http://publications.europa.eu/resource/authority/file-type/WMTS_SRVC": [
-            "wmts"
-        ],
-        "http://publications.europa.eu/resource/authority/file-type/XLS": [
-            "xls",
-            "xlsx",
-        ],
-        "http://publications.europa.eu/resource/authority/file-type/XML": ["xml"],
-        "http://publications.europa.eu/resource/authority/file-type/ZIP": ["zip", "gz"],
-    }
+    """Map a format name, file extension, filename or mimetype to the URI of a valid
+    DCAT-AP file type, or return None.
+    """
     try:
-        resource_format_lower = resource_format.lower()
-        for key, values in list(format_mapping.items()):
-            if resource_format_lower in values:
-                return key
+        value = resource_format.split(";", 1)[0].strip().lower()
     except AttributeError:
         return None
 
+    uri = VALID_FORMAT_INDEX.get(value)
+    if uri is None and "." in value:
+        # a filename or an extension with a leading dot
+        uri = VALID_FORMAT_INDEX.get(value.rsplit(".", 1)[1])
+    return uri
+
+
+def guess_media_type(filename):
+    """Guess the mimetype of a file from its name. Extensions that the mimetypes
+    module does not know are looked up in VALID_FORMATS.
+    """
+    guess, encoding = mimetypes.guess_type(filename, strict=False)
+    if guess is None and encoding is None:
+        uri = map_to_valid_format(os.path.basename(filename))
+        guess = VALID_FORMAT_MEDIA_TYPES.get(uri)
+    return guess
+
 
 def localize_change_dict(changes):
     """Localize titles and descriptions in a list of changes to a package,
@@ -511,7 +672,11 @@ def clean_up_list_fields(search_data, validated_dict):
     The package to be updated is found using package_show and validated against
     our schema, so all the extra fields are added to the package dict. We don't
     need them in the Solr document and they will cause an atomic error if left in.
+
+    validated_dict must be the parsed value of search_data["validated_data_dict"].
+    The json string is only serialised again if a field had to be added back.
     """
+    validated_dict_changed = False
     for key in [
         "contact_points",
         "relations",
@@ -527,8 +692,10 @@ def clean_up_list_fields(search_data, validated_dict):
                 # validation and I can't work out why. If this has happened, add
                 # them back now.
                 validated_dict[key] = search_data[key]
+                validated_dict_changed = True
             del search_data[key]
-    search_data["validated_data_dict"] = json.dumps(validated_dict)
+    if validated_dict_changed:
+        search_data["validated_data_dict"] = json_dumps(validated_dict)
 
     res_description = search_data.get("res_description", [])
     if len(res_description) > 0 and not isinstance(res_description[0], str):
@@ -536,8 +703,8 @@ def clean_up_list_fields(search_data, validated_dict):
         # of each resource description, dumped to a string). If the package dict was
         # found using package_show, it will be a list of dicts.
         search_data["res_description"] = [
-            json.dumps(description)
-            for description in search_data.get("res_description", [])
+            description if isinstance(description, str) else json_dumps(description)
+            for description in res_description
         ]
 
 
@@ -1,14 +1,187 @@
-import itertools
 import logging
+import math
+import time
 
+import ckan.model as model
 import ckan.plugins.toolkit as tk
+import sqlalchemy as sa
+from ckan.lib import search
 from ckan.logic import NotFound, ValidationError
 from ckan.plugins.toolkit import get_or_bust, side_effect_free
+from dateutil.parser import parse as dateutil_parse
 
-from ckanext.harvest.model import HarvestJob, HarvestObject, HarvestSource
+from ckanext.dcat.utils import catalog_uri
+from ckanext.harvest.model import HarvestJob, HarvestSource
+from ckanext.switzerland.cache import LRUCache
 
 log = logging.getLogger(__name__)
 
+CLEANUP_BATCH_SIZE = 1000
+REINDEX_BATCH_SIZE = 100
+CATALOG_DATASETS_PER_PAGE = 100
+
+# Finished jobs of a harvest source, except the latest :keep ones. The jobs to keep
+# are selected by id, so that a job created at the same time as a kept one is not
+# deleted with the older jobs.
+_DELETE_JOBS_SUBQUERY = """
+    select id from harvest_job
+    where source_id = :source_id
+    and status = 'Finished'
+    and id not in (
+        select id from harvest_job
+        where source_id = :source_id
+        and status = 'Finished'
+        order by created desc, id desc
+        limit :keep
+    )
+"""
+
+# The jobs to delete that have no current harvest objects left. The current object of
+# a dataset stays in the job that imported it until the dataset is imported again,
+# which can take many jobs if the harvester skips unchanged datasets.
+_DELETE_JOBS_WITHOUT_CURRENT_OBJECTS_SUBQUERY = (
+    _DELETE_JOBS_SUBQUERY
+    + """
+    and not exists (
+        select 1 from harvest_object
+        where harvest_object.harvest_job_id = harvest_job.id
+        and harvest_object.current
+    )
+"""
+)
+
+# The next batch of harvest objects belonging to the jobs to delete, except the
+# current ones. The ids are ordered so that the statements of one batch all select
+# the same objects.
+_DELETE_OBJECTS_BATCH_SUBQUERY = """
+    select id from harvest_object
+    where harvest_job_id in ({jobs})
+    and current is not true
+    order by id
+    limit :batch_size
+""".format(
+    jobs=_DELETE_JOBS_SUBQUERY
+)
+
+DELETE_OBJECT_ERRORS_SQL = """
+    delete from harvest_object_error
+    where harvest_object_id in ({objects})
+""".format(
+    objects=_DELETE_OBJECTS_BATCH_SUBQUERY
+)
+
+DELETE_OBJECT_EXTRAS_SQL = """
+    delete from harvest_object_extra
+    where harvest_object_id in ({objects})
+""".format(
+    objects=_DELETE_OBJECTS_BATCH_SUBQUERY
+)
+
+DELETE_OBJECTS_SQL = """
+    delete from harvest_object
+    where id in ({objects})
+""".format(
+    objects=_DELETE_OBJECTS_BATCH_SUBQUERY
+)
+
+DELETE_GATHER_ERRORS_SQL = """
+    delete from harvest_gather_error
+    where harvest_job_id in ({jobs})
+""".format(
+    jobs=_DELETE_JOBS_WITHOUT_CURRENT_OBJECTS_SUBQUERY
+)
+
+DELETE_JOBS_SQL = """
+    delete from harvest_job
+    where id in ({jobs})
+""".format(
+    jobs=_DELETE_JOBS_WITHOUT_CURRENT_OBJECTS_SUBQUERY
+)
+
+COUNT_DELETE_JOBS_SQL = """
+    select count(*) from ({jobs}) as jobs
+""".format(
+    jobs=_DELETE_JOBS_WITHOUT_CURRENT_OBJECTS_SUBQUERY
+)
+
+COUNT_DELETE_OBJECTS_SQL = """
+    select count(*) from harvest_object
+    where harvest_job_id in ({jobs})
+    and current is not true
+""".format(
+    jobs=_DELETE_JOBS_SUBQUERY
+)
+
+# Maps dataset identifiers to package ids. It is filled lazily by
+# get_package_id_by_identifier and kept up to date by the OgdchPackagePlugin
+# hooks. Entries are checked against the database with a single query before they
+# are used, so an entry that went stale in another process is dropped and looked up
+# again.
+identifier_index = LRUCache(maxsize=4096)
+
+
+def get_package_id_by_identifier(identifier):
+    """Get the id of the active dataset with the given identifier, or None.
+
+    The identifier is stored as a package extra, so we can resolve it with a
+    database query instead of a Solr search. This also finds datasets that have
+    been created in the same transaction or harvest job, but are not indexed yet.
+    """
+    query = (
+        model.Session.query(model.PackageExtra.package_id)
+        .join(model.Package, model.Package.id == model.PackageExtra.package_id)
+        .filter(model.PackageExtra.key == "identifier")
+        .filter(model.PackageExtra.value == identifier)
+        .filter(model.Package.state == "active")
+    )
+
+    package_id = identifier_index.get(identifier)
+    if package_id is not None:
+        # the same indexed query, restricted to the cached package
+        if query.filter(model.PackageExtra.package_id == package_id).first():
+            return package_id
+        identifier_index.pop(identifier)
+
+    result = query.first()
+    if result is None:
+        return None
+
+    identifier_index.set(identifier, result.package_id)
+    return result.package_id
+
+
+def get_package_ids_to_reindex(since=None):
+    """Get the ids of all packages that should be in the search index, ordered by
+    id. If since is given, only packages modified since then are returned.
+    """
+    query = model.Session.query(model.Package.id)
+    if tk.config.get("ckan.search.remove_deleted_packages"):
+        query = query.filter(model.Package.state != "deleted")
+    if since is not None:
+        query = query.filter(model.Package.metadata_modified >= since)
+    return [row.id for row in query.order_by(model.Package.id)]
+
+
+def reindex_packages(package_ids):
+    """Update the search index documents of the given packages without committing
+    them to Solr. The caller has to call ckan.lib.search.commit() when all
+    packages are indexed.
+
+    Returns the ids of the packages that could not be indexed.
+    """
+    package_index = search.index_for(model.Package)
+    failed = []
+    for package_id in package_ids:
+        context = {"ignore_auth": True, "validate": False, "use_cache": False}
+        try:
+            pkg_dict = tk.get_action("package_show")(context, {"id": package_id})
+            package_index.update_dict(pkg_dict, defer_commit=True)
+        except Exception as e:
+            log.error("Error while indexing dataset {}: {!r}".format(package_id, e))
+            failed.append(package_id)
+    model.Session.remove()
+    return failed
+
 
 @side_effect_free
 def ogdch_dataset_by_identifier(context, data_dict):
@@ -16,13 +189,97 @@ def ogdch_dataset_by_identifier(context, data_dict):
     context.update({"user": user["name"]})
     identifier = get_or_bust(data_dict, "identifier")
 
-    param = 'identifier:"%s"' % identifier
-    result = tk.get_action("package_search")(context, {"fq": param})
-    try:
-        return result["results"][0]
-    except (KeyError, IndexError, TypeError):
+    package_id = get_package_id_by_identifier(identifier)
+    if package_id is None:
         raise NotFound
 
+    return tk.get_action("package_show")(context, {"id": package_id})
+
+
+def search_catalog_datasets(context, data_dict):
+    """Searches the datasets of one page of the DCAT catalog. Same as
+    _search_ckan_datasets of ckanext-dcat, which is used by the dcat_catalog_show
+    action.
+    """
+    rows = int(
+        tk.config.get("ckanext.dcat.datasets_per_page", CATALOG_DATASETS_PER_PAGE)
+    )
+    page = _get_catalog_page(data_dict)
+
+    search_data_dict = {
+        "rows": rows,
+        "start": rows * (page - 1),
+        "sort": "metadata_modified desc",
+        "q": data_dict.get("q") or "*:*",
+        "fq": data_dict.get("fq"),
+        "fq_list": ["-dataset_type:harvest", "-dataset_type:showcase"],
+    }
+
+    modified_since = data_dict.get("modified_since")
+    if modified_since:
+        try:
+            modified_since = dateutil_parse(modified_since).isoformat() + "Z"
+        except (ValueError, AttributeError):
+            raise ValidationError("Wrong modified date format. Use ISO-8601 format")
+        search_data_dict["fq_list"].append(
+            "metadata_modified:[{0} TO NOW]".format(modified_since)
+        )
+
+    return tk.get_action("package_search")(context, search_data_dict)
+
+
+def catalog_pagination_info(query, data_dict):
+    """Returns the Hydra pagination of one page of the DCAT catalog, where query is
+    the result of search_catalog_datasets. Same as _pagination_info of
+    ckanext-dcat.
+    """
+    page = _get_catalog_page(data_dict)
+    if query["count"] == 0:
+        return {}
+
+    items_per_page = int(
+        tk.config.get("ckanext.dcat.datasets_per_page", CATALOG_DATASETS_PER_PAGE)
+    )
+    last_page = int(math.ceil(query["count"] / items_per_page)) or 1
+    pagination_info = {
+        "count": query["count"],
+        "items_per_page": items_per_page,
+        "current": _catalog_page_url(page),
+        "first": _catalog_page_url(1),
+        "last": _catalog_page_url(last_page),
+    }
+
+    if page > 1:
+        if (page - 1) * items_per_page + len(query["results"]) <= query["count"]:
+            pagination_info["previous"] = _catalog_page_url(page - 1)
+        else:
+            pagination_info["previous"] = _catalog_page_url(last_page)
+
+    if page * items_per_page < query["count"]:
+        pagination_info["next"] = _catalog_page_url(page + 1)
+
+    return pagination_info
+
+
+def _get_catalog_page(data_dict):
+    try:
+        page = int(data_dict.get("page") or 1)
+    except ValueError:
+        page = 0
+    if page < 1:
+        raise ValidationError("Page param must be a positive integer starting in 1")
+    return page
+
+
+def _catalog_page_url(page):
+    params = [
+        "{0}={1}".format(key, value)
+        for key, value in tk.request.args.items()
+        if key in ("modified_since", "profiles", "q", "fq")
+    ]
+    params.append("page={0}".format(page))
+    return "{0}{1}?{2}".format(catalog_uri(), tk.request.path, "&".join(params))
+
 
 def ogdch_cleanup_harvestjobs(context, data_dict):
     """Cleans up the database for harvest objects and related tables for all
@@ -31,12 +288,19 @@ def ogdch_cleanup_harvestjobs(context, data_dict):
     configuration parameter for how many jobs to keep per source.
     The command can be called with or without a source. In the latter case all
     sources are cleaned.
+
+    The harvest objects are deleted in batches of 'batch_size' objects, each in
+    its own transaction, so that the harvest tables are never locked for long.
+    'sleep_between_batches' (seconds) throttles the deletion, and 'max_runtime'
+    (seconds) stops the cleanup once it has run for that long.
+
+    The current harvest objects of the datasets are never deleted, and neither are
+    the jobs they belong to.
     """
 
     # check access rights
     tk.check_access("harvest_sources_clear", context, data_dict)
     model = context["model"]
-    log.error("checked access rights")
 
     # get sources from data_dict
     if "harvest_source_id" in data_dict:
@@ -49,12 +313,9 @@ def ogdch_cleanup_harvestjobs(context, data_dict):
     else:
         sources_to_cleanup = model.Session.query(HarvestSource).all()
 
-    log.error("got sources:")
-    log.error([s.id for s in sources_to_cleanup])
-
     # get number of jobs to keep form data_dict
     if "number_of_jobs_to_keep" in data_dict:
-        number_of_jobs_to_keep = data_dict["number_of_jobs_to_keep"]
+        number_of_jobs_to_keep = int(data_dict["number_of_jobs_to_keep"])
     else:
         log.error("Configuration missing for number of harvest jobs to keep")
         raise ValidationError(
@@ -62,6 +323,10 @@ def ogdch_cleanup_harvestjobs(context, data_dict):
         )
 
     dryrun = data_dict.get("dryrun", False)
+    batch_size = int(data_dict.get("batch_size", CLEANUP_BATCH_SIZE))
+    sleep_between_batches = float(data_dict.get("sleep_between_batches", 0))
+    max_runtime = data_dict.get("max_runtime")
+    deadline = time.monotonic() + float(max_runtime) if max_runtime else None
 
     log.info(
         "Harvest job cleanup called for sources: {},"
@@ -72,80 +337,139 @@ def ogdch_cleanup_harvestjobs(context, data_dict):
 
     # store cleanup result
     cleanup_result = {}
+    finished = True
     for source in sources_to_cleanup:
-        # get jobs ordered by their creations date
-        delete_jobs = (
-            model.Session.query(HarvestJob)
+        if deadline is not None and time.monotonic() > deadline:
+            log.info("Harvest job cleanup reached its maximum runtime, stopping")
+            finished = False
+            break
+
+        number_of_finished_jobs = (
+            model.Session.query(HarvestJob.id)
             .filter(HarvestJob.source_id == source.id)
             .filter(HarvestJob.status == "Finished")
-            .order_by(HarvestJob.created.desc())
-            .all()[number_of_jobs_to_keep:]
+            .count()
         )
 
-        # decide which jobs to keep or delete on their order
-        delete_jobs_ids = [job.id for job in delete_jobs]
-
-        if not delete_jobs:
+        if number_of_finished_jobs <= number_of_jobs_to_keep:
             log.debug(
                 "Cleanup harvest jobs for source {}: nothing to do".format(source.id)
             )
+            continue
+
+        params = {"source_id": source.id, "keep": number_of_jobs_to_keep}
+
+        if dryrun:
+            result = _count_harvest_jobs_to_delete(model, params)
         else:
-            # log all job for a source with the decision to delete or keep them
-            log.debug(
-                "Cleanup harvest jobs for source {}: delete jobs: {}".format(
-                    source.id, delete_jobs_ids
-                )
+            result = _delete_harvest_jobs(
+                context,
+                source.id,
+                params,
+                batch_size,
+                sleep_between_batches,
+                deadline,
             )
+            finished = result["finished"]
 
-            # get harvest objects for harvest jobs
-            delete_objects_ids = (
-                model.Session.query(HarvestObject.id)
-                .filter(HarvestObject.harvest_job_id.in_(delete_jobs_ids))
-                .all()
-            )
-            delete_objects_ids = list(itertools.chain(*delete_objects_ids))
+        cleanup_result[source.id] = result
 
-            # log all objects to delete
-            log.debug(
-                "Cleanup harvest objects for source {}: delete {} objects".format(
-                    source.id, len(delete_objects_ids)
-                )
+        log.info(
+            "Cleanup harvest jobs for source {}: deleted {} jobs and {} "
+            "objects{}".format(
+                source.id,
+                result["deleted_nr_jobs"],
+                result["deleted_nr_objects"],
+                " (dry run)" if dryrun else "",
             )
+        )
 
-            # perform delete
-            sql = """begin;
-            delete from harvest_object_error
-            where harvest_object_id in ('{delete_objects_values}');
-            delete from harvest_object_extra
-            where harvest_object_id in ('{delete_objects_values}');
-            delete from harvest_object
-            where id in ('{delete_objects_values}');
-            delete from harvest_gather_error
-            where harvest_job_id in ('{delete_jobs_values}');
-            delete from harvest_job
-            where id in ('{delete_jobs_values}');
-            commit;
-            """.format(
-                delete_objects_values="','".join(delete_objects_ids),
-                delete_jobs_values="','".join(delete_jobs_ids),
-            )
+        if not finished:
+            log.info("Harvest job cleanup reached its maximum runtime, stopping")
+            break
+
+    # return result of action
+    return {
+        "sources": [s.id for s in sources_to_cleanup],
+        "cleanup": cleanup_result,
+        "finished": finished,
+    }
+
+
+def _count_harvest_jobs_to_delete(model, params):
+    return {
+        "deleted_nr_jobs": model.Session.execute(
+            sa.text(COUNT_DELETE_JOBS_SQL), params
+        ).scalar(),
+        "deleted_nr_objects": model.Session.execute(
+            sa.text(COUNT_DELETE_OBJECTS_SQL), params
+        ).scalar(),
+        "finished": True,
+    }
+
+
+def _delete_harvest_jobs(
+    context, source_id, params, batch_size, sleep_between_batches, deadline
+):
+    """Delete the harvest jobs of a source except the latest ones to keep, together
+    with their objects. Current objects and the jobs they belong to are kept.
+
+    If the deadline is reached before all objects are deleted, the jobs are kept
+    and the next cleanup run picks up where this one stopped.
+    """
+    model = context["model"]
+    deleted_nr_objects, finished = _delete_harvest_objects(
+        model, source_id, params, batch_size, sleep_between_batches, deadline
+    )
+
+    deleted_nr_jobs = 0
+    if finished:
+        model.Session.execute(sa.text(DELETE_GATHER_ERRORS_SQL), params)
+        deleted_nr_jobs = model.Session.execute(
+            sa.text(DELETE_JOBS_SQL), params
+        ).rowcount
+        model.Session.commit()
+
+    tk.get_action("harvest_source_reindex")(context, {"id": source_id})
+
+    return {
+        "deleted_nr_jobs": deleted_nr_jobs,
+        "deleted_nr_objects": deleted_nr_objects,
+        "finished": finished,
+    }
 
-            # only execute the sql if it is not a dry run
-            if not dryrun:
-                model.Session.execute(sql)
 
-                # reindex after deletions
-                tk.get_action("harvest_source_reindex")(context, {"id": source.id})
+def _delete_harvest_objects(
+    model, source_id, params, batch_size, sleep_between_batches, deadline
+):
+    """Delete the harvest objects of the jobs to delete in batches, committing
+    after each batch.
 
-            # fill result
-            cleanup_result[source.id] = {
-                "deleted_jobs": delete_jobs,
-                "deleted_nr_objects": len(delete_objects_ids),
-            }
+    Returns the number of deleted objects and whether all objects have been
+    deleted.
+    """
+    deleted_nr_objects = 0
+    batch_params = dict(params, batch_size=batch_size)
+
+    while True:
+        model.Session.execute(sa.text(DELETE_OBJECT_ERRORS_SQL), batch_params)
+        model.Session.execute(sa.text(DELETE_OBJECT_EXTRAS_SQL), batch_params)
+        deleted = model.Session.execute(
+            sa.text(DELETE_OBJECTS_SQL), batch_params
+        ).rowcount
+        model.Session.commit()
+
+        deleted_nr_objects += deleted
 
-            log.info(
-                "cleaned resource and shacl result directories {}".format(source.id)
+        log.info(
+            "Cleanup harvest jobs for source {}: deleted {} objects".format(
+                source_id, deleted_nr_objects
             )
+        )
 
-    # return result of action
-    return {"sources": sources_to_cleanup, "cleanup": cleanup_result}
+        if deleted < batch_size:
+            return deleted_nr_objects, True
+        if deadline is not None and time.monotonic() > deadline:
+            return deleted_nr_objects, False
+        if sleep_between_batches:
+            time.sleep(sleep_between_batches)
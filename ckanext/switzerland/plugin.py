@@ -1,4 +1,3 @@
-import json
 import logging
 import os
 import sys
@@ -9,12 +8,37 @@ import ckan.plugins as plugins
 import ckan.plugins.toolkit as toolkit
 
 import ckanext.switzerland.helpers as sh
+from ckanext.switzerland import cli
 from ckanext.switzerland import logic as l
 from ckanext.switzerland import validators as v
-from ckanext.switzerland.blueprints import ogdch_dataset, ogdch_home
+from ckanext.switzerland.blueprints import ogdch_catalog, ogdch_dataset, ogdch_home
+from ckanext.switzerland.cache import LRUCache
+from ckanext.switzerland.dcat.processors import invalidate_dataset_fragments
 
 log = logging.getLogger(__name__)
 
+# Default Solr boosts of the language-specific fields in a dataset search. "title"
+# and "text" apply to the language of the request, the others to all other
+# languages.
+SEARCH_BOOST_DEFAULTS = {
+    "title": "8",
+    "text": "4",
+    "title_other_lang": "2",
+    "text_other_lang": "1",
+}
+
+# Fields of the groups and the organization in a package dict that contain
+# multilingual json strings
+MULTILINGUAL_GROUP_FIELDS = ("title", "display_name", "description")
+
+# Parsed multilingual fields of groups and organizations, see
+# OgdchPackagePlugin._parse_multilingual_group_fields
+parsed_group_fields = LRUCache(maxsize=1024)
+
+# Localized multilingual fields of groups and organizations by group id and
+# language, see OgdchLanguagePlugin._get_localized_group_or_org_fields
+localized_groups = LRUCache(maxsize=1024)
+
 
 class OgdchPlugin(plugins.SingletonPlugin):
     plugins.implements(plugins.IConfigurer)
@@ -24,6 +48,7 @@ class OgdchPlugin(plugins.SingletonPlugin):
     plugins.implements(plugins.ITranslation)
     plugins.implements(plugins.IBlueprint, inherit=True)
     plugins.implements(plugins.IFacets)
+    plugins.implements(plugins.IClick)
 
     # IConfigurer
 
@@ -61,6 +86,7 @@ class OgdchPlugin(plugins.SingletonPlugin):
         """
         return {
             "ogdch_dataset_by_identifier": l.ogdch_dataset_by_identifier,
+            "ogdch_cleanup_harvestjobs": l.ogdch_cleanup_harvestjobs,
         }
 
     # ITemplateHelpers
@@ -73,6 +99,7 @@ class OgdchPlugin(plugins.SingletonPlugin):
             "get_localized_value": sh.get_localized_value,
             "parse_and_localize": sh.parse_and_localize,
             "get_frequency_name": sh.get_frequency_name,
+            "get_frequency_uri": sh.get_frequency_uri,
             "get_readable_file_size": sh.get_readable_file_size,
             "parse_json": sh.parse_json,
             "convert_post_data_to_dict": sh.convert_post_data_to_dict,
@@ -122,7 +149,11 @@ class OgdchPlugin(plugins.SingletonPlugin):
     # IBlueprint
 
     def get_blueprint(self):
-        return [ogdch_dataset, ogdch_home]
+        blueprints = [ogdch_dataset, ogdch_home]
+        if plugins.plugin_loaded("dcat"):
+            # streams the catalog endpoint of ckanext-dcat, see read_catalog
+            blueprints.append(ogdch_catalog)
+        return blueprints
 
     # IFacets
 
@@ -146,6 +177,11 @@ class OgdchPlugin(plugins.SingletonPlugin):
     def organization_facets(self, facets_dict, organization_type, package_type):
         return self._update_facets(facets_dict)
 
+    # IClick
+
+    def get_commands(self):
+        return cli.get_commands()
+
 
 # monkey patch template helpers to return translated names/titles
 h.dataset_display_name = sh.dataset_display_name
@@ -168,28 +204,67 @@ class OgdchLanguagePlugin(plugins.SingletonPlugin):
         return False
 
     def _prepare_group_or_org_json(self, group_or_org_dict):
-        # parse all json strings in dict
-        group_or_org_dict = self._parse_json_strings(group_or_org_dict)
-
-        # map ckan fields
-        group_or_org_dict = self._group_or_org_map_ckan_default_fields(
-            group_or_org_dict
-        )
-
         # Do not change the resulting dict for API requests and form saves.
         # _reduce_to_requested_language removes all translation dicts needed
         # to show the form on resource_edit, so we skip it here
         if sh.request_is_api_request() or toolkit.request.method == "POST":
-            return group_or_org_dict
+            # parse all json strings in dict
+            group_or_org_dict = self._parse_json_strings(group_or_org_dict)
+
+            # map ckan fields
+            return self._group_or_org_map_ckan_default_fields(group_or_org_dict)
 
         # replace langauge dicts with requested language strings
         desired_lang_code = sh.get_request_language()
+        localized_fields = self._get_localized_group_or_org_fields(
+            group_or_org_dict, desired_lang_code
+        )
+        for field in MULTILINGUAL_GROUP_FIELDS:
+            group_or_org_dict.pop(field, None)
+
+        group_or_org_dict = self._parse_json_strings(group_or_org_dict)
+        group_or_org_dict = self._group_or_org_map_ckan_default_fields(
+            group_or_org_dict
+        )
         group_or_org_dict = self._reduce_to_requested_language(
             group_or_org_dict, desired_lang_code
         )
+        group_or_org_dict.update(localized_fields)
 
         return group_or_org_dict
 
+    def _get_localized_group_or_org_fields(self, group_or_org_dict, lang_code):
+        """Get the localized multilingual fields of a group or organization.
+
+        The result is cached per group and language. Groups have no revision id, so
+        the raw values of the multilingual fields are stored with the cached result
+        and compared on every lookup. The cache entries of a group are also dropped
+        when it is updated or deleted, see _invalidate_localized_group_or_org.
+        """
+        fields = {
+            field: group_or_org_dict[field]
+            for field in MULTILINGUAL_GROUP_FIELDS
+            if field in group_or_org_dict
+        }
+        revision = tuple(
+            (field, tuple(sorted(value.items())) if isinstance(value, dict) else value)
+            for field, value in fields.items()
+        )
+        key = (group_or_org_dict.get("id"), lang_code)
+        cached = localized_groups.get(key)
+        if cached is not None and cached[0] == revision:
+            return cached[1]
+
+        fields = self._parse_json_strings(fields)
+        fields = self._group_or_org_map_ckan_default_fields(fields)
+        fields = self._reduce_to_requested_language(fields, lang_code)
+        localized_groups.set(key, (revision, fields))
+        return fields
+
+    def _invalidate_localized_group_or_org(self, group_id):
+        for lang_code in sh.get_langs():
+            localized_groups.pop((group_id, lang_code))
+
     def _prepare_package_json(self, pkg_dict):
         # parse all json strings in dict
         pkg_dict = self._parse_json_strings(pkg_dict)
@@ -272,6 +347,12 @@ class OgdchGroupPlugin(OgdchLanguagePlugin):
     def before_view(self, pkg_dict):
         return super(OgdchGroupPlugin, self).before_view(pkg_dict)
 
+    def edit(self, entity):
+        self._invalidate_localized_group_or_org(entity.id)
+
+    def delete(self, entity):
+        self._invalidate_localized_group_or_org(entity.id)
+
 
 class OgdchOrganizationPlugin(OgdchLanguagePlugin):
     plugins.implements(plugins.IOrganizationController, inherit=True)
@@ -280,10 +361,22 @@ class OgdchOrganizationPlugin(OgdchLanguagePlugin):
     def before_view(self, pkg_dict):
         return super(OgdchOrganizationPlugin, self).before_view(pkg_dict)
 
+    def edit(self, entity):
+        self._invalidate_localized_group_or_org(entity.id)
+
+    def delete(self, entity):
+        self._invalidate_localized_group_or_org(entity.id)
+
 
 class OgdchPackagePlugin(OgdchLanguagePlugin):
+    plugins.implements(plugins.IConfigurable, inherit=True)
     plugins.implements(plugins.IPackageController, inherit=True)
 
+    # IConfigurable
+
+    def configure(self, config):
+        self._build_query_fields(config)
+
     def is_supported_package_type(self, pkg_dict):
         # only package type 'dataset' is supported (not harvesters!)
         try:
@@ -306,6 +399,26 @@ class OgdchPackagePlugin(OgdchLanguagePlugin):
 
         return self._prepare_package_json(pkg_dict)
 
+    def after_dataset_create(self, context, pkg_dict):
+        if self.is_supported_package_type(pkg_dict):
+            self._update_identifier_index(pkg_dict)
+
+    def after_dataset_update(self, context, pkg_dict):
+        if self.is_supported_package_type(pkg_dict):
+            self._update_identifier_index(pkg_dict)
+            invalidate_dataset_fragments(pkg_dict.get("id"))
+
+    def after_dataset_delete(self, context, pkg_dict):
+        invalidate_dataset_fragments(pkg_dict["id"])
+        package = context["model"].Package.get(pkg_dict["id"])
+        if package is not None:
+            l.identifier_index.pop(package.extras.get("identifier"))
+
+    def _update_identifier_index(self, pkg_dict):
+        identifier = pkg_dict.get("identifier")
+        if identifier and pkg_dict.get("id"):
+            l.identifier_index.set(identifier, pkg_dict["id"])
+
     def after_dataset_show(self, context, pkg_dict):
         if not self.is_supported_package_type(pkg_dict):
             return pkg_dict
@@ -315,15 +428,11 @@ class OgdchPackagePlugin(OgdchLanguagePlugin):
         # groups
         if pkg_dict["groups"] is not None:
             for group in pkg_dict["groups"]:
-                for field in group:
-                    group[field] = sh.parse_json(group[field])
+                self._parse_multilingual_group_fields(group)
 
         # organization
         if pkg_dict["organization"] is not None:
-            for field in pkg_dict["organization"]:
-                pkg_dict["organization"][field] = sh.parse_json(
-                    pkg_dict["organization"][field]
-                )
+            self._parse_multilingual_group_fields(pkg_dict["organization"])
 
         if sh.request_is_api_request() and not toolkit.request.method == "POST":
             # We want to convert datetimes to Europe/Zurich and include the time zone
@@ -333,23 +442,51 @@ class OgdchPackagePlugin(OgdchLanguagePlugin):
 
         return pkg_dict
 
+    def _parse_multilingual_group_fields(self, group_dict):
+        """Parse the multilingual json strings of a group or organization that is
+        embedded in a package dict. The other fields never contain json, so they are
+        left alone. The parsed values are cached by group id and raw field values,
+        so every version of a group is only parsed once.
+        """
+        raw_values = tuple(
+            group_dict.get(field) if isinstance(group_dict.get(field), str) else None
+            for field in MULTILINGUAL_GROUP_FIELDS
+        )
+        key = (group_dict.get("id"),) + raw_values
+        parsed_fields = parsed_group_fields.get(key)
+        if parsed_fields is None:
+            parsed_fields = {
+                field: sh.parse_json(value)
+                for field, value in zip(MULTILINGUAL_GROUP_FIELDS, raw_values)
+                if value is not None
+            }
+            parsed_group_fields.set(key, parsed_fields)
+
+        for field, value in parsed_fields.items():
+            # copy the cached dicts, so that changes to the package dict do not
+            # end up in the cache
+            group_dict[field] = dict(value) if isinstance(value, dict) else value
+
     def before_dataset_index(self, search_data):
         if not self.is_supported_package_type(search_data):
             return search_data
 
         extract_title = LangToString("title")
-        validated_dict = json.loads(search_data["validated_data_dict"])
-
-        search_data["res_name"] = [
-            extract_title(r) for r in validated_dict["resources"]
-        ]
-        search_data["res_format"] = [
-            r["format"] for r in validated_dict["resources"] if "format" in r
-        ]
-        search_data["res_rights"] = [
-            sh.simplify_terms_of_use(r.get("rights", ""))
-            for r in validated_dict["resources"]
-        ]
+        # Parse the validated dict once and hand it on to the helpers below, so
+        # that the json is not decoded and encoded again for every step.
+        validated_dict = sh.json_loads(search_data["validated_data_dict"])
+
+        res_name = []
+        res_format = []
+        res_rights = []
+        for resource in validated_dict["resources"]:
+            res_name.append(extract_title(resource))
+            if "format" in resource:
+                res_format.append(resource["format"])
+            res_rights.append(sh.simplify_terms_of_use(resource.get("rights", "")))
+        search_data["res_name"] = res_name
+        search_data["res_format"] = res_format
+        search_data["res_rights"] = res_rights
         search_data["title_string"] = extract_title(validated_dict)
         search_data["description"] = LangToString("description")(validated_dict)
 
@@ -364,32 +501,65 @@ class OgdchPackagePlugin(OgdchLanguagePlugin):
         """Search in correct language-specific field and boost results in current
         language
         """
-        lang_set = sh.get_langs()
         try:
             current_lang = toolkit.request.environ["CKAN_LANG"]
         except (KeyError, RuntimeError):
             # This happens when this code gets called as part of a paster
             # command rather then as part of an HTTP request.
-            current_lang = toolkit.config.get("ckan.locale_default")
+            current_lang = None
 
         # fallback to default locale if locale not in suported langs
-        if current_lang not in lang_set:
-            current_lang = toolkit.config.get("ckan.locale_default", "en")
-        # treat current lang differenly so remove from set
-        lang_set.remove(current_lang)
-
-        # add default query field(s)
-        query_fields = "text"
-
-        # weight current lang more highly
-        query_fields += " title_%s^8 text_%s^4" % (current_lang, current_lang)
+        try:
+            search_params["qf"] = self._query_fields[current_lang]
+        except KeyError:
+            search_params["qf"] = self._default_query_fields
 
-        for lang in lang_set:
-            query_fields += " title_%s^2 text_%s" % (lang, lang)
+        return search_params
 
-        search_params["qf"] = query_fields + " res_name res_description"
+    def _build_query_fields(self, config):
+        """Build the Solr query fields for each supported language, so that
+        before_dataset_search only has to look them up.
+        """
+        boosts = {
+            key: self._get_search_boost(config, key, default)
+            for key, default in SEARCH_BOOST_DEFAULTS.items()
+        }
+        self._query_fields = {}
+        for current_lang in sh.get_langs():
+            # add default query field(s)
+            query_fields = ["text"]
+
+            # weight current lang more highly
+            query_fields.append("title_%s%s" % (current_lang, boosts["title"]))
+            query_fields.append("text_%s%s" % (current_lang, boosts["text"]))
+
+            for lang in sh.get_langs():
+                if lang == current_lang:
+                    continue
+                query_fields.append("title_%s%s" % (lang, boosts["title_other_lang"]))
+                query_fields.append("text_%s%s" % (lang, boosts["text_other_lang"]))
+
+            query_fields.extend(["res_name", "res_description"])
+            self._query_fields[current_lang] = " ".join(query_fields)
+
+        default_lang = config.get("ckan.locale_default", "en")
+        self._default_query_fields = self._query_fields.get(
+            default_lang, self._query_fields["en"]
+        )
 
-        return search_params
+    def _get_search_boost(self, config, key, default):
+        boost = str(config.get("ckanext.switzerland.search_boost." + key, default))
+        try:
+            value = float(boost)
+        except ValueError:
+            raise ValueError(
+                "ckanext.switzerland.search_boost.{} must be a number, got {}".format(
+                    key, boost
+                )
+            )
+        if value == 1:
+            return ""
+        return "^" + boost.strip()
 
 
 class OgdchResourcePlugin(plugins.SingletonPlugin):
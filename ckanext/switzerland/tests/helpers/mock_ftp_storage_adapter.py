@@ -41,15 +41,16 @@ class MockFTPStorageAdapter(FTPStorageAdapter):
         modified = self.filesystem.getmodified(os.path.join(folder, filename))
         return modified.replace(tzinfo=None)
 
-    def fetch(self, filename, localpath=None):
+    def fetch(self, filename, localpath=None, sink=None):
         if not localpath:
             localpath = os.path.join(self._config["localpath"], filename)
 
-        localfile = open(localpath, "wb")
+        localfile = sink or open(localpath, "wb")
 
         content = self.filesystem.readbytes(os.path.join(self.cwd, filename))
         localfile.write(content)
-        localfile.close()
+        if sink is None:
+            localfile.close()
         return "226 Transfer complete"
 
 
@@ -0,0 +1,36 @@
+from ckanext.switzerland.cache import LRUCache
+
+
+def test_get_returns_default_for_missing_key():
+    cache = LRUCache()
+
+    assert cache.get("missing") is None
+    assert cache.get("missing", "default") == "default"
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = LRUCache(maxsize=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+
+    # reading "a" makes "b" the least recently used entry
+    assert cache.get("a") == 1
+    cache.set("c", 3)
+
+    assert "a" in cache
+    assert "b" not in cache
+    assert "c" in cache
+    assert len(cache) == 2
+
+
+def test_pop_and_clear():
+    cache = LRUCache()
+    cache.set("a", 1)
+    cache.set("b", 2)
+
+    assert cache.pop("a") == 1
+    assert cache.pop("a") is None
+    assert len(cache) == 1
+
+    cache.clear()
+    assert len(cache) == 0
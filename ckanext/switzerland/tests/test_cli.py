@@ -0,0 +1,122 @@
+import datetime
+import itertools
+from unittest import mock
+
+import pytest
+
+from ckanext.harvest import model as harvest_model
+from ckanext.harvest.tests.factories import (
+    HarvestJobObj,
+    HarvestObjectObj,
+    HarvestSourceObj,
+)
+from ckanext.switzerland.cli import ogdch
+from ckanext.switzerland.harvester.sbb_harvester import SBBHarvester
+
+from . import data
+
+
+@pytest.mark.usefixtures("with_plugins", "clean_db", "clean_index")
+class TestCleanupHarvestjobs(object):
+    def _create_source_with_jobs(self, number_of_jobs, objects_per_job):
+        organization = data.organization(data.user())
+        source = HarvestSourceObj(
+            url="http://example.com/harvest",
+            source_type=SBBHarvester().info()["name"],
+            owner_org=organization["id"],
+        )
+        for i in range(number_of_jobs):
+            job = HarvestJobObj(source=source)
+            for _ in range(objects_per_job):
+                HarvestObjectObj(job=job)
+            job.status = "Finished"
+            job.created = datetime.datetime(2024, 1, 1) + datetime.timedelta(days=i)
+            job.save()
+        return source
+
+    def test_cleanup_harvestjobs(self, cli):
+        source = self._create_source_with_jobs(3, 2)
+
+        result = cli.invoke(
+            ogdch, ["cleanup-harvestjobs", "--source", source.id, "--keep", "1"]
+        )
+
+        assert result.exit_code == 0, result.output
+        assert "{}: deleted 2 jobs and 4 objects".format(source.id) in result.output
+        assert harvest_model.HarvestJob.count() == 1
+        assert harvest_model.HarvestObject.count() == 2
+
+    def test_cleanup_harvestjobs_dry_run(self, cli):
+        source = self._create_source_with_jobs(3, 2)
+
+        result = cli.invoke(
+            ogdch,
+            ["cleanup-harvestjobs", "--source", source.id, "--keep", "1", "--dry-run"],
+        )
+
+        assert result.exit_code == 0, result.output
+        assert "{}: would delete 2 jobs and 4 objects".format(source.id) in (
+            result.output
+        )
+        assert harvest_model.HarvestJob.count() == 3
+        assert harvest_model.HarvestObject.count() == 6
+
+    def test_cleanup_harvestjobs_sleeps_between_batches(self, cli):
+        source = self._create_source_with_jobs(3, 2)
+
+        with mock.patch("ckanext.switzerland.logic.time") as time:
+            result = cli.invoke(
+                ogdch,
+                [
+                    "cleanup-harvestjobs",
+                    "--source",
+                    source.id,
+                    "--keep",
+                    "1",
+                    "--batch-size",
+                    "2",
+                    "--sleep-between-batches",
+                    "0.5",
+                ],
+            )
+
+        assert result.exit_code == 0, result.output
+        # each full batch is followed by a sleep, the third batch is empty
+        assert time.sleep.call_args_list == [mock.call(0.5), mock.call(0.5)]
+        assert harvest_model.HarvestObject.count() == 2
+
+    def test_cleanup_harvestjobs_stops_at_max_runtime(self, cli):
+        source = self._create_source_with_jobs(3, 2)
+
+        with mock.patch("ckanext.switzerland.logic.time") as time:
+            # the deadline is reached after the first batch
+            time.monotonic.side_effect = itertools.chain([0, 0], itertools.repeat(100))
+            result = cli.invoke(
+                ogdch,
+                [
+                    "cleanup-harvestjobs",
+                    "--source",
+                    source.id,
+                    "--keep",
+                    "1",
+                    "--batch-size",
+                    "2",
+                    "--max-runtime",
+                    "10",
+                ],
+            )
+
+        assert result.exit_code == 0, result.output
+        assert "Maximum runtime reached" in result.output
+        # the jobs are kept until all their objects are deleted
+        assert harvest_model.HarvestJob.count() == 3
+        assert harvest_model.HarvestObject.count() == 4
+
+    def test_cleanup_harvestjobs_without_keep(self, cli, ckan_config, monkeypatch):
+        monkeypatch.delitem(
+            ckan_config, "ckanext.switzerland.number_harvest_jobs_per_source", False
+        )
+
+        result = cli.invoke(ogdch, ["cleanup-harvestjobs"])
+
+        assert result.exit_code != 0
@@ -0,0 +1,201 @@
+import json
+from unittest import mock
+
+import ckan.tests.factories as factories
+import ckan.tests.helpers as helpers
+import pytest
+
+from ckanext.dcat.processors import RDFParser
+from ckanext.harvest import model as harvest_model
+from ckanext.harvest.model import HarvestObject
+from ckanext.harvest.tests.factories import HarvestJobObj, HarvestSourceObj
+from ckanext.switzerland.dcat.harvesters import SwissDCATRDFHarvester
+
+CATALOG_URL = "http://example.org/catalog.nt"
+
+CATALOG = """
+<http://example.org/dataset/1> <http://www.w3.org/1999/02/22-rdf-syntax-ns#type> <http://www.w3.org/ns/dcat#Dataset> .
+<http://example.org/dataset/1> <http://purl.org/dc/terms/identifier> "dataset-1@org" .
+<http://example.org/dataset/1> <http://purl.org/dc/terms/title> "Dataset 1"@de .
+<http://example.org/dataset/2> <http://www.w3.org/1999/02/22-rdf-syntax-ns#type> <http://www.w3.org/ns/dcat#Dataset> .
+<http://example.org/dataset/2> <http://purl.org/dc/terms/identifier> "dataset-2@org" .
+<http://example.org/dataset/2> <http://purl.org/dc/terms/title> "Dataset 2"@de .
+"""  # noqa: E501
+
+PAGINATION = """
+<http://example.org/catalog.nt> <http://www.w3.org/1999/02/22-rdf-syntax-ns#type> <http://www.w3.org/ns/hydra/core#PagedCollection> .
+<http://example.org/catalog.nt> <http://www.w3.org/ns/hydra/core#nextPage> "{next_page}" .
+"""  # noqa: E501
+
+
+@pytest.mark.ckan_config("ckan.plugins", "ogdch harvest dcat dcat_ch_rdf_harvester")
+@pytest.mark.ckan_config("ckanext.dcat.rdf.profiles", "swiss_dcat_ap")
+@pytest.mark.usefixtures("with_plugins", "clean_db", "clean_index")
+class TestSwissDCATRDFHarvesterGather(object):
+    def _create_job(self, **config):
+        source = HarvestSourceObj(
+            url=CATALOG_URL,
+            source_type="dcat_ch_rdf",
+            config=json.dumps(dict(config, rdf_format="nt")),
+        )
+        return HarvestJobObj(source=source)
+
+    def _gather(self, harvest_job, content=CATALOG):
+        harvester = SwissDCATRDFHarvester()
+        with mock.patch.object(
+            harvester, "_get_content_and_type", return_value=(content, "nt")
+        ), mock.patch(
+            "ckanext.switzerland.dcat.harvesters.RDFParser", wraps=RDFParser
+        ) as parser:
+            object_ids = harvester.gather_stage(harvest_job)
+        return object_ids, parser
+
+    def _import(self, harvest_job, object_ids):
+        """Mark the gathered objects as imported, as the import stage does."""
+        for object_id in object_ids:
+            obj = HarvestObject.get(object_id)
+            previous = HarvestObject.filter(guid=obj.guid, current=True).first()
+            if previous:
+                obj.package_id = previous.package_id
+                previous.current = False
+                previous.save()
+            else:
+                obj.package_id = factories.Dataset()["id"]
+            obj.current = True
+            obj.state = "COMPLETE"
+            obj.save()
+        harvest_job.status = "Finished"
+        harvest_job.save()
+
+    def test_gather_stage_parses_windows_with_the_configured_profiles(self):
+        object_ids, parser = self._gather(self._create_job(window_size=1))
+
+        # one parser per window of one dataset
+        assert parser.call_args_list == [mock.call(profiles=["swiss_dcat_ap"])] * 2
+        objects = [HarvestObject.get(object_id) for object_id in object_ids]
+        assert sorted(obj.guid for obj in objects) == [
+            "http://example.org/dataset/1",
+            "http://example.org/dataset/2",
+        ]
+        assert sorted(json.loads(obj.content)["identifier"] for obj in objects) == [
+            "dataset-1@org",
+            "dataset-2@org",
+        ]
+
+    def test_gather_stage_uses_the_profiles_of_the_source_config(self):
+        object_ids, parser = self._gather(
+            self._create_job(profiles=["swiss_dcat_ap", "euro_dcat_ap"])
+        )
+
+        assert parser.call_args_list == [
+            mock.call(profiles=["swiss_dcat_ap", "euro_dcat_ap"])
+        ]
+        assert len(object_ids) == 2
+
+    def test_validate_config_rejects_invalid_profiles(self):
+        with pytest.raises(ValueError):
+            SwissDCATRDFHarvester().validate_config(json.dumps({"profiles": [1]}))
+
+    def test_gather_stage_skips_unchanged_datasets(self):
+        first_job = self._create_job()
+        self._import(first_job, self._gather(first_job)[0])
+
+        second_job = HarvestJobObj(source=first_job.source)
+        changed = CATALOG.replace('"Dataset 2"@de', '"Dataset 2 changed"@de')
+        object_ids, _ = self._gather(second_job, changed)
+
+        assert [HarvestObject.get(object_id).guid for object_id in object_ids] == [
+            "http://example.org/dataset/2"
+        ]
+
+    def test_gather_stage_with_force_all_gathers_unchanged_datasets(self):
+        first_job = self._create_job(force_all=True)
+        self._import(first_job, self._gather(first_job)[0])
+
+        second_job = HarvestJobObj(source=first_job.source)
+        object_ids, _ = self._gather(second_job)
+
+        assert len(object_ids) == 2
+
+    def test_cleanup_keeps_the_jobs_of_skipped_datasets(self):
+        first_job = self._create_job()
+        self._import(first_job, self._gather(first_job)[0])
+        changed = CATALOG.replace('"Dataset 2"@de', '"Dataset 2 changed"@de')
+        for _ in range(2):
+            job = HarvestJobObj(source=first_job.source)
+            self._import(job, self._gather(job, changed)[0])
+            changed = changed.replace("changed", "changed again")
+
+        result = helpers.call_action(
+            "ogdch_cleanup_harvestjobs",
+            harvest_source_id=first_job.source.id,
+            number_of_jobs_to_keep=1,
+        )
+
+        # The first job holds the current object of the skipped dataset 1, only
+        # its object of dataset 2 is deleted together with the second job
+        assert result["cleanup"][first_job.source.id]["deleted_nr_jobs"] == 1
+        assert result["cleanup"][first_job.source.id]["deleted_nr_objects"] == 2
+        assert harvest_model.HarvestJob.get(first_job.id) is not None
+        assert HarvestObject.filter(current=True).count() == 2
+
+        # Dataset 1 is still skipped
+        last_job = HarvestJobObj(source=first_job.source)
+        object_ids, _ = self._gather(last_job, changed)
+        assert [HarvestObject.get(object_id).guid for object_id in object_ids] == [
+            "http://example.org/dataset/2"
+        ]
+
+    def test_gather_stage_creates_one_object_per_dataset(self):
+        first_page = CATALOG + PAGINATION.format(next_page=CATALOG_URL + "?page=2")
+        second_page = CATALOG.replace("Dataset 1", "Dataset 1 again")
+        harvester = SwissDCATRDFHarvester()
+        with mock.patch.object(
+            harvester,
+            "_get_content_and_type",
+            side_effect=[(first_page, "nt"), (second_page, "nt")],
+        ):
+            object_ids = harvester.gather_stage(self._create_job())
+
+        objects = [HarvestObject.get(object_id) for object_id in object_ids]
+        assert sorted(obj.guid for obj in objects) == [
+            "http://example.org/dataset/1",
+            "http://example.org/dataset/2",
+        ]
+        # the dataset is imported as found last
+        titles = sorted(json.loads(obj.content)["title"]["de"] for obj in objects)
+        assert titles == ["Dataset 1 again", "Dataset 2"]
+        assert all(len(obj.extras) == 1 for obj in objects)
+
+
+class TestSwissDCATRDFHarvesterImportRate(object):
+    def _harvest_object(self, source_config):
+        harvest_object = mock.Mock()
+        harvest_object.job.source.config = json.dumps(source_config)
+        return harvest_object
+
+    @mock.patch("ckanext.switzerland.dcat.harvesters.time")
+    def test_import_waits_for_the_import_rate(self, time):
+        time.monotonic.side_effect = [10, 10.1]
+
+        SwissDCATRDFHarvester()._throttle_import(
+            self._harvest_object({"import_rate": 2}), 10
+        )
+
+        time.sleep.assert_called_once_with(pytest.approx(0.4))
+
+    @mock.patch("ckanext.switzerland.dcat.harvesters.time")
+    def test_slow_import_does_not_wait(self, time):
+        time.monotonic.return_value = 11
+
+        SwissDCATRDFHarvester()._throttle_import(
+            self._harvest_object({"import_rate": 2}), 10
+        )
+
+        time.sleep.assert_not_called()
+
+    @mock.patch("ckanext.switzerland.dcat.harvesters.time")
+    def test_import_without_import_rate_does_not_wait(self, time):
+        SwissDCATRDFHarvester()._throttle_import(self._harvest_object({}), 10)
+
+        time.sleep.assert_not_called()
@@ -0,0 +1,164 @@
+import hashlib
+import io
+import zipfile
+from unittest import mock
+
+import pytest
+
+from ckanext.switzerland.harvester.formats import (
+    FetchSink,
+    FormatSniffer,
+    open_zip_member,
+    read_zip_members,
+    sniff_file,
+)
+
+
+def _zip_file():
+    content = io.BytesIO()
+    with zipfile.ZipFile(content, "w", zipfile.ZIP_DEFLATED) as zip_file:
+        zip_file.writestr("stops.txt", "stop_id,stop_name\n" * 100)
+        zip_file.writestr("Fahrplän.xml", "<timetable/>")
+    return content.getvalue()
+
+
+def _zip64_file():
+    content = io.BytesIO()
+    # Write the zip64 end of central directory record of zip files with more than
+    # ZIP_FILECOUNT_LIMIT members, without writing as many members
+    with mock.patch("zipfile.ZIP_FILECOUNT_LIMIT", 1):
+        with zipfile.ZipFile(content, "w", zipfile.ZIP_DEFLATED) as zip_file:
+            with zip_file.open("stops.txt", "w", force_zip64=True) as member:
+                member.write(b"stop_id,stop_name\n" * 100)
+            zip_file.writestr("Fahrplän.xml", "<timetable/>")
+    return content.getvalue()
+
+
+@pytest.mark.parametrize(
+    "filename,content,expected",
+    [
+        ("timetable.zip", _zip_file(), ("ZIP", "application/zip", "text/plain")),
+        ("timetable", _zip_file(), ("ZIP", "application/zip", "text/plain")),
+        ("timetable.zip", _zip64_file(), ("ZIP", "application/zip", "text/plain")),
+        ("timetable.zip", b"PK\x03\x04", ("ZIP", "application/zip", None)),
+        ("stops.csv", b"stop_id,stop_name\n", ("CSV", "text/csv", None)),
+        ("unknown", b"stop_id,stop_name\n", None),
+    ],
+)
+def test_sniff_file(tmp_path, filename, content, expected):
+    path = tmp_path / filename
+    path.write_bytes(content)
+
+    assert sniff_file(str(path)) == expected
+
+
+def test_read_zip_members():
+    members = read_zip_members(io.BytesIO(_zip_file()))
+
+    assert [member.filename for member in members] == ["stops.txt", "Fahrplän.xml"]
+    assert members[0].file_size == len("stop_id,stop_name\n" * 100)
+    assert members[0].compress_type == zipfile.ZIP_DEFLATED
+
+
+def test_read_zip_members_of_zip64_file():
+    members = read_zip_members(io.BytesIO(_zip64_file()))
+
+    assert [member.filename for member in members] == ["stops.txt", "Fahrplän.xml"]
+
+
+def test_read_zip_members_of_invalid_zip_file():
+    assert read_zip_members(io.BytesIO(b"PK\x03\x04" + b"\x00" * 100)) is None
+
+
+@pytest.mark.parametrize(
+    "compression",
+    [zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED, zipfile.ZIP_BZIP2, zipfile.ZIP_LZMA],
+)
+@pytest.mark.parametrize("force_zip64", [False, True])
+def test_open_zip_member(compression, force_zip64):
+    stops = "".join("{},Stop {}\n".format(i, i) for i in range(10000)).encode()
+    content = io.BytesIO()
+    with zipfile.ZipFile(content, "w", compression) as zip_file:
+        zip_file.writestr("agency.txt", "agency_id,agency_name\n")
+        with zip_file.open("stops.txt", "w", force_zip64=force_zip64) as member:
+            member.write(stops)
+
+    members = read_zip_members(content)
+    with mock.patch.object(zipfile.ZipFile, "_RealGetContents") as read_directory:
+        member_file = open_zip_member(content, members[1])
+
+        assert member_file.read() == stops
+    read_directory.assert_not_called()
+
+
+def test_open_zip_member_with_invalid_local_header():
+    content = io.BytesIO(_zip_file())
+    members = read_zip_members(content)
+    members[1].header_offset += 1
+
+    with pytest.raises(zipfile.BadZipFile):
+        open_zip_member(content, members[1])
+
+
+@pytest.mark.parametrize("content", [_zip_file(), _zip64_file()])
+def test_format_sniffer_detects_format_while_writing(content):
+    sniffer = FormatSniffer("timetable.zip")
+    for i in range(0, len(content), 100):
+        sniffer.update(content[i : i + 100])
+
+    assert sniffer.result() == ("ZIP", "application/zip", "text/plain")
+    assert [member.filename for member in sniffer.zip_members] == [
+        "stops.txt",
+        "Fahrplän.xml",
+    ]
+
+
+def test_fetch_sink_collects_facts_while_writing(tmp_path):
+    content = _zip_file()
+    path = tmp_path / "timetable.zip"
+    with FetchSink(str(path)) as sink:
+        for i in range(0, len(content), 100):
+            sink.write(content[i : i + 100])
+
+    assert path.read_bytes() == content
+    assert sink.facts() == {
+        "size": len(content),
+        "sha256": hashlib.sha256(content).hexdigest(),
+        "format": "ZIP",
+        "mimetype": "application/zip",
+        "mimetype_inner": "text/plain",
+        "zip_members": ["stops.txt", "Fahrplän.xml"],
+    }
+
+
+def test_fetch_sink_reads_central_directory_outside_of_tail(tmp_path):
+    content = _zip_file()
+    path = tmp_path / "timetable.zip"
+    with mock.patch("ckanext.switzerland.harvester.formats.ZIP_TAIL_SIZE", 10):
+        with FetchSink(str(path)) as sink:
+            for i in range(0, len(content), 10):
+                sink.write(content[i : i + 10])
+
+        # the central directory is read from the written file
+        facts = sink.facts()
+        assert facts["mimetype_inner"] == "text/plain"
+        assert facts["zip_members"] == ["stops.txt", "Fahrplän.xml"]
+
+
+def test_fetch_sink_limits_zip_member_names(tmp_path):
+    content = _zip_file()
+    path = tmp_path / "timetable.zip"
+    with mock.patch("ckanext.switzerland.harvester.formats.ZIP_MEMBER_NAMES_LIMIT", 1):
+        with FetchSink(str(path)) as sink:
+            sink.write(content)
+
+        assert sink.facts()["zip_members"] == ["stops.txt"]
+
+
+def test_fetch_sink_creates_missing_directory(tmp_path):
+    path = tmp_path / "workingdir" / "stops.csv"
+    with FetchSink(str(path)) as sink:
+        sink.write(b"stop_id,stop_name\n")
+
+    assert path.read_bytes() == b"stop_id,stop_name\n"
+    assert sink.facts()["format"] == "CSV"
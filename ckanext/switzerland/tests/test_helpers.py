@@ -1,6 +1,16 @@
+import json
+
 import pytest
 
-from ckanext.switzerland.helpers import map_to_valid_format
+from ckanext.switzerland.helpers import (
+    clean_up_list_fields,
+    get_frequency_name,
+    get_frequency_uri,
+    guess_media_type,
+    map_to_valid_format,
+    ogdch_get_accrual_periodicity_choices,
+    ogdch_get_license_choices,
+)
 
 CSV_URI = "http://publications.europa.eu/resource/authority/file-type/CSV"
 GEOJSON_URI = "http://publications.europa.eu/resource/authority/file-type/GEOJSON"
@@ -57,7 +67,86 @@ INVALID_FORMAT = None
         (None, INVALID_FORMAT),
         ("", INVALID_FORMAT),
         ("exe", INVALID_FORMAT),
+        (".csv", CSV_URI),
+        ("Data.CSV", CSV_URI),
+        ("text/csv", CSV_URI),
+        ("text/csv; charset=utf-8", CSV_URI),
+        ("application/geo+json", GEOJSON_URI),
+        ("application/vnd.ms-excel", XLS_URI),
+        ("file.exe", INVALID_FORMAT),
     ],
 )
 def test_map_to_valid_format_known_values(input_format, expected):
     assert map_to_valid_format(input_format) == expected
+
+
+@pytest.mark.parametrize(
+    "filename,expected",
+    [
+        ("data.csv", "text/csv"),
+        ("/tmp/data.geojson", "application/geo+json"),
+        ("data.gpkg", "application/geopackage+sqlite3"),
+        ("data.gz", None),
+        ("data.unknown", None),
+    ],
+)
+def test_guess_media_type(filename, expected):
+    assert guess_media_type(filename) == expected
+
+
+def test_clean_up_list_fields_keeps_validated_data_dict_string():
+    validated_data_dict = json.dumps({"id": "test", "keywords": {"de": ["Bahn"]}})
+    search_data = {
+        "validated_data_dict": validated_data_dict,
+        "keywords": {"de": ["Bahn"]},
+        "res_description": [{"de": "Beschreibung"}],
+    }
+
+    clean_up_list_fields(search_data, json.loads(validated_data_dict))
+
+    assert "keywords" not in search_data
+    assert search_data["validated_data_dict"] is validated_data_dict
+    assert json.loads(search_data["res_description"][0]) == {"de": "Beschreibung"}
+
+
+def test_clean_up_list_fields_adds_missing_fields():
+    validated_data_dict = json.dumps({"id": "test"})
+    search_data = {
+        "validated_data_dict": validated_data_dict,
+        "temporals": [{"start_date": "2020-01-01"}],
+    }
+
+    clean_up_list_fields(search_data, json.loads(validated_data_dict))
+
+    assert "temporals" not in search_data
+    assert json.loads(search_data["validated_data_dict"]) == {
+        "id": "test",
+        "temporals": [{"start_date": "2020-01-01"}],
+    }
+
+
+def test_get_frequency_name_and_uri():
+    uri = "http://publications.europa.eu/resource/authority/frequency/ANNUAL"
+
+    assert get_frequency_name(uri) == "Annual"
+    assert get_frequency_uri("Annual") == uri
+    assert get_frequency_name("unknown") == "unknown"
+    assert get_frequency_uri("unknown") == "unknown"
+
+
+def test_get_frequency_uri_of_every_frequency_name():
+    names = get_frequency_name(get_map=True)
+
+    assert {get_frequency_uri(name) for name in names.values()} == set(names)
+
+
+def test_cached_choices_can_not_be_changed_by_callers():
+    uri = "http://publications.europa.eu/resource/authority/frequency/ANNUAL"
+
+    get_frequency_name(get_map=True)[uri] = "Changed"
+    ogdch_get_accrual_periodicity_choices(None)[0]["label"] = "Changed"
+    ogdch_get_license_choices(None).clear()
+
+    assert get_frequency_name(uri) == "Annual"
+    assert ogdch_get_accrual_periodicity_choices(None)[0]["label"] != "Changed"
+    assert len(ogdch_get_license_choices(None)) == 4
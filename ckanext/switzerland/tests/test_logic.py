@@ -0,0 +1,204 @@
+import datetime
+
+import ckan.model as model
+import ckan.tests.helpers as helpers
+import pytest
+from ckan.lib import search
+from ckan.logic import NotFound
+
+from ckanext.harvest import model as harvest_model
+from ckanext.harvest.tests.factories import (
+    HarvestJobObj,
+    HarvestObjectObj,
+    HarvestSourceObj,
+)
+from ckanext.switzerland.harvester.sbb_harvester import SBBHarvester
+from ckanext.switzerland.logic import (
+    get_package_ids_to_reindex,
+    identifier_index,
+    reindex_packages,
+)
+
+from . import data
+
+
+@pytest.mark.usefixtures("with_plugins", "clean_db", "clean_index")
+class TestOgdchDatasetByIdentifier(object):
+    def test_dataset_found_by_identifier(self):
+        dataset = data.dataset()
+
+        result = helpers.call_action(
+            "ogdch_dataset_by_identifier", identifier=data.dataset_name
+        )
+
+        assert result["id"] == dataset["id"]
+        assert result["identifier"] == data.dataset_name
+
+    def test_dataset_found_when_not_in_cache(self):
+        dataset = data.dataset()
+        identifier_index.clear()
+
+        result = helpers.call_action(
+            "ogdch_dataset_by_identifier", identifier=data.dataset_name
+        )
+
+        assert result["id"] == dataset["id"]
+        assert identifier_index.get(data.dataset_name) == dataset["id"]
+
+    def test_stale_cache_entry_is_looked_up_again(self):
+        dataset = data.dataset()
+        identifier_index.set(data.dataset_name, "stale-package-id")
+
+        result = helpers.call_action(
+            "ogdch_dataset_by_identifier", identifier=data.dataset_name
+        )
+
+        assert result["id"] == dataset["id"]
+        assert identifier_index.get(data.dataset_name) == dataset["id"]
+
+    def test_changed_identifier_is_not_found(self):
+        dataset = data.dataset()
+        helpers.call_action(
+            "package_patch", id=dataset["id"], identifier="New identifier"
+        )
+
+        with pytest.raises(NotFound):
+            helpers.call_action(
+                "ogdch_dataset_by_identifier", identifier=data.dataset_name
+            )
+
+        result = helpers.call_action(
+            "ogdch_dataset_by_identifier", identifier="New identifier"
+        )
+        assert result["id"] == dataset["id"]
+
+    def test_deleted_dataset_is_not_found(self):
+        dataset = data.dataset()
+        helpers.call_action("package_delete", id=dataset["id"])
+
+        with pytest.raises(NotFound):
+            helpers.call_action(
+                "ogdch_dataset_by_identifier", identifier=data.dataset_name
+            )
+
+
+@pytest.mark.usefixtures("with_plugins", "clean_db", "clean_index")
+class TestOgdchCleanupHarvestjobs(object):
+    def _create_source(self):
+        organization = data.organization(data.user())
+        return HarvestSourceObj(
+            url="http://example.com/harvest",
+            source_type=SBBHarvester().info()["name"],
+            owner_org=organization["id"],
+        )
+
+    def _create_finished_jobs(self, source, number_of_jobs, objects_per_job):
+        jobs = []
+        for i in range(number_of_jobs):
+            job = HarvestJobObj(source=source)
+            for _ in range(objects_per_job):
+                HarvestObjectObj(job=job)
+            job.status = "Finished"
+            job.created = datetime.datetime(2024, 1, 1) + datetime.timedelta(days=i)
+            job.save()
+            jobs.append(job)
+        return jobs
+
+    def test_cleanup_keeps_latest_jobs(self):
+        source = self._create_source()
+        jobs = self._create_finished_jobs(source, 3, 3)
+
+        result = helpers.call_action(
+            "ogdch_cleanup_harvestjobs",
+            harvest_source_id=source.id,
+            number_of_jobs_to_keep=1,
+            batch_size=2,
+        )
+
+        assert result["cleanup"][source.id]["deleted_nr_jobs"] == 2
+        assert result["cleanup"][source.id]["deleted_nr_objects"] == 6
+        assert harvest_model.HarvestJob.count() == 1
+        assert harvest_model.HarvestObject.count() == 3
+        assert harvest_model.HarvestJob.get(jobs[-1].id) is not None
+
+    def test_cleanup_keeps_job_created_at_the_same_time(self):
+        source = self._create_source()
+        jobs = self._create_finished_jobs(source, 2, 1)
+        jobs[0].created = jobs[1].created
+        jobs[0].save()
+
+        result = helpers.call_action(
+            "ogdch_cleanup_harvestjobs",
+            harvest_source_id=source.id,
+            number_of_jobs_to_keep=1,
+        )
+
+        assert result["cleanup"][source.id]["deleted_nr_jobs"] == 1
+        assert harvest_model.HarvestJob.count() == 1
+        assert harvest_model.HarvestObject.count() == 1
+
+    def test_cleanup_keeps_current_objects_and_their_jobs(self):
+        source = self._create_source()
+        jobs = self._create_finished_jobs(source, 3, 2)
+        current = jobs[0].objects[0]
+        current.current = True
+        current.save()
+
+        result = helpers.call_action(
+            "ogdch_cleanup_harvestjobs",
+            harvest_source_id=source.id,
+            number_of_jobs_to_keep=1,
+        )
+
+        assert result["cleanup"][source.id]["deleted_nr_jobs"] == 1
+        assert result["cleanup"][source.id]["deleted_nr_objects"] == 3
+        assert harvest_model.HarvestJob.get(jobs[0].id) is not None
+        assert harvest_model.HarvestJob.get(jobs[1].id) is None
+        assert harvest_model.HarvestObject.get(current.id) is not None
+        assert harvest_model.HarvestObject.count() == 3
+
+    def test_cleanup_dryrun_deletes_nothing(self):
+        source = self._create_source()
+        self._create_finished_jobs(source, 3, 2)
+
+        result = helpers.call_action(
+            "ogdch_cleanup_harvestjobs",
+            harvest_source_id=source.id,
+            number_of_jobs_to_keep=1,
+            dryrun=True,
+        )
+
+        assert result["cleanup"][source.id]["deleted_nr_jobs"] == 2
+        assert result["cleanup"][source.id]["deleted_nr_objects"] == 4
+        assert harvest_model.HarvestJob.count() == 3
+        assert harvest_model.HarvestObject.count() == 6
+
+
+@pytest.mark.usefixtures("with_plugins", "clean_db", "clean_index")
+class TestReindex(object):
+    def test_package_ids_modified_since(self):
+        dataset = data.dataset()
+        package = model.Package.get(dataset["id"])
+        package.metadata_modified = datetime.datetime(2020, 1, 1)
+        model.Session.commit()
+
+        assert dataset["id"] in get_package_ids_to_reindex()
+        assert dataset["id"] in get_package_ids_to_reindex(
+            datetime.datetime(2019, 12, 31)
+        )
+        assert dataset["id"] not in get_package_ids_to_reindex(
+            datetime.datetime(2020, 1, 2)
+        )
+
+    def test_reindex_packages(self):
+        dataset = data.dataset()
+        search.clear_all()
+
+        assert reindex_packages([dataset["id"]]) == []
+        search.commit()
+
+        result = helpers.call_action("package_search", fq="id:" + dataset["id"])
+        assert result["count"] == 1
+
+    def test_reindex_packages_returns_failed_ids(self):
+        assert reindex_packages(["does-not-exist"]) == ["does-not-exist"]
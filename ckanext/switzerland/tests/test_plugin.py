@@ -1,14 +1,22 @@
 import datetime
+import io
 import json
 import logging
+import zipfile
+from unittest import mock
 from zoneinfo import ZoneInfo
 
+import ckan.lib.uploader as uploader
+import ckan.plugins as plugins
 import ckan.tests.helpers as helpers
 import pytest
+import rdflib
 import time_machine
 from bs4 import BeautifulSoup
 from ckan.lib.helpers import url_for
 
+from ckanext.switzerland.dcat.profiles import DCAT
+
 from . import data
 
 log = logging.getLogger(__name__)
@@ -181,6 +189,31 @@ class TestOgdchPackagePlugin(object):
         actual_dataset_fields = [th.text for th in table.find_all("th", scope="row")]
         assert actual_dataset_fields == expected_dataset_fields
 
+    def test_organization_and_group_fields_parsed_on_show(self):
+        user = data.user()
+        organization = data.organization(user)
+        helpers.call_action(
+            "organization_patch",
+            id=organization["id"],
+            title={"de": "Org DE", "fr": "Org FR", "it": "", "en": ""},
+        )
+        dataset = data.dataset()
+        helpers.call_action(
+            "package_patch", id=dataset["id"], owner_org=organization["id"]
+        )
+
+        for _ in range(2):
+            result = helpers.call_action("package_show", id=dataset["id"])
+
+            assert result["organization"]["title"] == {
+                "de": "Org DE",
+                "fr": "Org FR",
+                "it": "",
+                "en": "",
+            }
+            assert result["organization"]["name"] == organization["name"]
+            result["organization"]["title"]["de"] = "Changed"
+
     def test_dataset_permalink(self, app):
         self._create_dataset()
         resp = app.get(url_for("dataset.read", id="dataset", qualified=True))
@@ -190,6 +223,21 @@ class TestOgdchPackagePlugin(object):
         assert permalink.text.strip() == "Permalink to the current resource"
         assert permalink["href"] == "/dataset/dataset/permalink"
 
+    def test_dataset_permalink_redirect_follows_updates(self, app):
+        self._create_dataset()
+        url = url_for("ogdch_dataset.dataset_permalink", id="dataset")
+
+        resp = app.get(url, follow_redirects=False)
+        assert resp.status_code == 302
+        assert resp.headers["Location"].endswith("my_file.csv")
+
+        helpers.call_action(
+            "package_patch", id="dataset", permalink="http://example.org/new.csv"
+        )
+
+        resp = app.get(url, follow_redirects=False)
+        assert resp.headers["Location"] == "http://example.org/new.csv"
+
     def test_get_correct_fields_for_resource_page(self, app):
         self._create_dataset()
         resp = self._get_resource_page(app)
@@ -226,6 +274,28 @@ class TestOgdchPackagePlugin(object):
         assert permalink.text == "Permalink"
         assert permalink["href"] == "/dataset/dataset/resource_permalink/my_file.csv"
 
+    def test_resource_permalink_redirect_follows_updates(self, app):
+        self._create_dataset()
+        url = url_for(
+            "ogdch_dataset.resource_permalink", id="dataset", filename="my_file.csv"
+        )
+
+        resp = app.get(url, follow_redirects=False)
+        assert resp.status_code == 302
+        resource = helpers.call_action("package_show", id="dataset")["resources"][0]
+        assert resp.headers["Location"] == resource["url"]
+
+        # resource_patch sets a new metadata_modified on the dataset, which
+        # invalidates the cached URLs in every process
+        helpers.call_action(
+            "resource_patch",
+            id=resource["id"],
+            url="http://example.org/other/my_file.csv",
+        )
+
+        resp = app.get(url, follow_redirects=False)
+        assert resp.headers["Location"] == "http://example.org/other/my_file.csv"
+
 
 @pytest.mark.usefixtures("with_plugins", "clean_db", "clean_index")
 class TestOgdchResourcePlugin(object):
@@ -258,3 +328,351 @@ class TestOgdchResourcePlugin(object):
         assert resource_update["format"] == "TXT"
         assert resource_update["size"] == 733
         assert resource_update["byte_size"] == 733
+
+    def test_conditional_resource_download(self, app, create_with_upload):
+        dataset = data.dataset()
+        resource = create_with_upload(
+            data.ist_file,
+            "file.txt",
+            context={"user": data.user()["name"]},
+            package_id=dataset["id"],
+            license="http://dcat-ap.ch/vocabulary/licenses/terms_open",
+        )
+        url = url_for(
+            "ogdch_dataset.resource_download",
+            id=dataset["id"],
+            resource_id=resource["id"],
+            filename="file.txt",
+        )
+
+        resp = app.get(url)
+        assert resp.status_code == 200
+        etag = resp.headers["ETag"]
+
+        resp = app.get(url, headers={"If-None-Match": etag})
+        assert resp.status_code == 304
+        assert resp.headers["ETag"] == etag
+
+        resp = app.get(url, headers={"Range": "bytes=0-9"})
+        assert resp.status_code == 206
+        assert len(resp.data) == 10
+
+    def test_resource_download_from_another_dataset_is_not_found(
+        self, app, create_with_upload
+    ):
+        user = data.user()
+        private_dataset = data.dataset("private-dataset")
+        resource = create_with_upload(
+            data.ist_file,
+            "file.txt",
+            context={"user": user["name"]},
+            package_id=private_dataset["id"],
+            license="http://dcat-ap.ch/vocabulary/licenses/terms_open",
+        )
+        helpers.call_action(
+            "package_patch",
+            id=private_dataset["id"],
+            identifier="Private dataset",
+            owner_org=data.organization(user)["id"],
+            private=True,
+        )
+        public_dataset = data.dataset()
+
+        resp = app.get(
+            url_for(
+                "ogdch_dataset.resource_download",
+                id=public_dataset["id"],
+                resource_id=resource["id"],
+                filename="file.txt",
+            )
+        )
+        assert resp.status_code == 404
+
+        resp = app.get(
+            url_for(
+                "ogdch_dataset.resource_download",
+                id=private_dataset["id"],
+                resource_id=resource["id"],
+                filename="file.txt",
+            )
+        )
+        assert resp.status_code == 403
+
+    def _create_uploaded_resource(self, create_with_upload):
+        dataset = data.dataset()
+        resource = create_with_upload(
+            data.ist_file,
+            "file.txt",
+            context={"user": data.user()["name"]},
+            package_id=dataset["id"],
+            license="http://dcat-ap.ch/vocabulary/licenses/terms_open",
+        )
+        url = url_for(
+            "ogdch_dataset.resource_download",
+            id=dataset["id"],
+            resource_id=resource["id"],
+            filename="file.txt",
+        )
+        return resource, url
+
+    @pytest.mark.ckan_config("ckanext.switzerland.download_offload", "x-sendfile")
+    def test_resource_download_offloaded_with_x_sendfile(self, app, create_with_upload):
+        resource, url = self._create_uploaded_resource(create_with_upload)
+        filepath = uploader.get_resource_uploader(resource).get_path(resource["id"])
+
+        resp = app.get(url)
+
+        assert resp.status_code == 200
+        assert resp.headers["X-Sendfile"] == filepath
+        assert resp.headers["Content-Disposition"] == "attachment; filename=file.txt"
+        assert resp.headers["ETag"]
+        assert resp.data == b""
+
+    @pytest.mark.ckan_config("ckanext.switzerland.download_offload", "x-accel-redirect")
+    @pytest.mark.ckan_config(
+        "ckanext.switzerland.download_offload_location", "/internal/files/"
+    )
+    def test_resource_download_offloaded_with_x_accel_redirect(
+        self, app, create_with_upload
+    ):
+        resource, url = self._create_uploaded_resource(create_with_upload)
+
+        resp = app.get(url)
+
+        assert resp.status_code == 200
+        # the path of the file relative to the resources directory of the storage
+        assert resp.headers["X-Accel-Redirect"] == "/internal/files/{}/{}/{}".format(
+            resource["id"][0:3], resource["id"][3:6], resource["id"][6:]
+        )
+        assert resp.data == b""
+
+    @pytest.mark.ckan_config("ckanext.switzerland.download_offload", "x-accel-redirect")
+    def test_resource_download_not_offloaded_without_local_storage(
+        self, app, create_with_upload
+    ):
+        resource, url = self._create_uploaded_resource(create_with_upload)
+
+        with mock.patch(
+            "ckanext.switzerland.blueprints.uploader.get_resource_uploader"
+        ) as get_resource_uploader:
+            upload = get_resource_uploader.return_value
+            upload.get_path.return_value = uploader.get_resource_uploader(
+                resource
+            ).get_path(resource["id"])
+            del upload.storage_path
+            resp = app.get(url)
+
+        assert resp.status_code == 200
+        assert "X-Accel-Redirect" not in resp.headers
+        assert len(resp.data) == 2538
+
+    def test_resource_zip_member_download(self, app, create_with_upload):
+        stops = "".join("{},Stop {}\n".format(i, i) for i in range(1000))
+        content = io.BytesIO()
+        with zipfile.ZipFile(content, "w", zipfile.ZIP_DEFLATED) as zip_file:
+            zip_file.writestr("agency.txt", "agency_id,agency_name\n")
+            zip_file.writestr("gtfs/stops.txt", stops)
+
+        dataset = data.dataset()
+        resource = create_with_upload(
+            content.getvalue(),
+            "timetable.zip",
+            context={"user": data.user()["name"]},
+            package_id=dataset["id"],
+            license="http://dcat-ap.ch/vocabulary/licenses/terms_open",
+        )
+
+        def member_url(member):
+            return url_for(
+                "ogdch_dataset.resource_zip_member",
+                id=dataset["id"],
+                resource_id=resource["id"],
+                member=member,
+            )
+
+        with mock.patch(
+            "ckanext.switzerland.blueprints.signals.resource_download"
+        ) as resource_download:
+            resp = app.get(member_url("gtfs/stops.txt"))
+        assert resp.status_code == 200
+        assert resp.get_data(as_text=True) == stops
+        assert resp.headers["Content-Disposition"] == "attachment; filename=stops.txt"
+        resource_download.send.assert_called_once_with(resource["id"])
+
+        resp = app.get(
+            member_url("gtfs/stops.txt"),
+            headers={"If-None-Match": resp.headers["ETag"]},
+        )
+        assert resp.status_code == 304
+
+        resp = app.get(member_url("routes.txt"))
+        assert resp.status_code == 404
+
+    def test_resource_zip_member_reads_central_directory_once(
+        self, app, create_with_upload
+    ):
+        content = io.BytesIO()
+        with zipfile.ZipFile(content, "w", zipfile.ZIP_DEFLATED) as zip_file:
+            zip_file.writestr("agency.txt", "agency_id,agency_name\n")
+            zip_file.writestr("stops.txt", "stop_id,stop_name\n")
+
+        dataset = data.dataset()
+        resource = create_with_upload(
+            content.getvalue(),
+            "timetable.zip",
+            context={"user": data.user()["name"]},
+            package_id=dataset["id"],
+            license="http://dcat-ap.ch/vocabulary/licenses/terms_open",
+        )
+
+        with mock.patch.object(
+            zipfile.ZipFile,
+            "_RealGetContents",
+            autospec=True,
+            side_effect=zipfile.ZipFile._RealGetContents,
+        ) as read_directory:
+            for member in ["agency.txt", "stops.txt", "agency.txt"]:
+                resp = app.get(
+                    url_for(
+                        "ogdch_dataset.resource_zip_member",
+                        id=dataset["id"],
+                        resource_id=resource["id"],
+                        member=member,
+                    )
+                )
+                assert resp.status_code == 200
+
+        assert resp.get_data(as_text=True) == "agency_id,agency_name\n"
+        assert read_directory.call_count == 1
+
+    def test_resource_zip_member_from_another_dataset_is_not_found(
+        self, app, create_with_upload
+    ):
+        content = io.BytesIO()
+        with zipfile.ZipFile(content, "w", zipfile.ZIP_DEFLATED) as zip_file:
+            zip_file.writestr("stops.txt", "stop_id,stop_name\n")
+
+        user = data.user()
+        private_dataset = data.dataset("private-dataset")
+        resource = create_with_upload(
+            content.getvalue(),
+            "timetable.zip",
+            context={"user": user["name"]},
+            package_id=private_dataset["id"],
+            license="http://dcat-ap.ch/vocabulary/licenses/terms_open",
+        )
+        helpers.call_action(
+            "package_patch",
+            id=private_dataset["id"],
+            identifier="Private dataset",
+            owner_org=data.organization(user)["id"],
+            private=True,
+        )
+        public_dataset = data.dataset()
+
+        resp = app.get(
+            url_for(
+                "ogdch_dataset.resource_zip_member",
+                id=public_dataset["id"],
+                resource_id=resource["id"],
+                member="stops.txt",
+            )
+        )
+        assert resp.status_code == 404
+
+
+@pytest.mark.usefixtures("with_plugins", "clean_db", "clean_index")
+class TestOgdchOrganizationPlugin(object):
+    def test_localized_title_updated_on_organization_page(self, app):
+        user = data.user()
+        organization = data.organization(user)
+        helpers.call_action(
+            "organization_patch",
+            id=organization["id"],
+            title={"de": "Org DE", "fr": "Org FR", "it": "Org IT", "en": "Org EN"},
+        )
+        url = url_for("organization.read", id=organization["name"])
+
+        resp = app.get(url)
+        assert "Org EN" in resp.body
+
+        helpers.call_action(
+            "organization_patch",
+            id=organization["id"],
+            title={"de": "New DE", "fr": "New FR", "it": "New IT", "en": "New EN"},
+        )
+
+        resp = app.get(url)
+        assert "New EN" in resp.body
+        assert "Org EN" not in resp.body
+
+
+@pytest.mark.ckan_config(
+    "ckan.plugins",
+    "ogdch ogdch_pkg ogdch_res ogdch_group ogdch_org dcat harvest fluent "
+    "scheming_datasets scheming_groups scheming_organizations activity",
+)
+@pytest.mark.ckan_config("ckanext.dcat.rdf.profiles", "swiss_dcat_ap")
+@pytest.mark.usefixtures("with_plugins", "clean_db", "clean_index")
+class TestOgdchCatalog(object):
+    @pytest.mark.parametrize(
+        "_format,content_type,rdflib_format",
+        [
+            ("ttl", "text/turtle", "turtle"),
+            ("rdf", "application/rdf+xml", "xml"),
+        ],
+    )
+    def test_catalog_is_streamed(self, app, _format, content_type, rdflib_format):
+        dataset = data.dataset()
+
+        resp = app.get("/catalog.{}".format(_format), status=200)
+
+        assert resp.headers["Content-Type"].startswith(content_type)
+        graph = rdflib.Graph().parse(data=resp.body, format=rdflib_format)
+        datasets = list(graph.subjects(rdflib.RDF.type, DCAT.Dataset))
+        assert len(datasets) == 1
+        assert str(graph.value(datasets[0], DCAT.landingPage)).endswith(dataset["name"])
+
+    def test_catalog_with_wrong_page(self, app):
+        resp = app.get("/catalog.ttl?page=0", status=409)
+
+        assert "Page param must be a positive integer" in resp.body
+
+    def test_catalog_jsonld_is_served_by_dcat(self, app):
+        data.dataset()
+
+        resp = app.get("/catalog.jsonld", status=200)
+
+        assert resp.headers["Content-Type"].startswith("application/ld+json")
+        graph = rdflib.Graph().parse(data=resp.body, format="json-ld")
+        assert len(list(graph.subjects(rdflib.RDF.type, DCAT.Dataset))) == 1
+
+
+@pytest.mark.usefixtures("with_plugins")
+class TestOgdchPackagePluginSearch(object):
+    def test_query_fields_for_default_language(self):
+        search_params = plugins.get_plugin("ogdch_pkg").before_dataset_search({})
+
+        assert search_params["qf"] == (
+            "text title_en^8 text_en^4 title_de^2 text_de title_fr^2 text_fr "
+            "title_it^2 text_it res_name res_description"
+        )
+
+    def test_query_fields_with_configured_boosts(self):
+        plugin = plugins.get_plugin("ogdch_pkg")
+        try:
+            plugin._build_query_fields(
+                {
+                    "ckan.locale_default": "de",
+                    "ckanext.switzerland.search_boost.title": "10",
+                    "ckanext.switzerland.search_boost.text_other_lang": "0.5",
+                }
+            )
+
+            assert plugin._query_fields["fr"] == (
+                "text title_fr^10 text_fr^4 title_en^2 text_en^0.5 title_de^2 "
+                "text_de^0.5 title_it^2 text_it^0.5 res_name res_description"
+            )
+            assert plugin._default_query_fields == plugin._query_fields["de"]
+        finally:
+            plugin._build_query_fields(plugins.toolkit.config)
@@ -1,12 +1,24 @@
 import pytest
 import rdflib
-
+from rdflib.compare import isomorphic
+from rdflib.namespace import Namespace
+
+from ckanext.dcat.processors import RDFSerializer
+from ckanext.switzerland.dcat.processors import (
+    LineBasedDatasetWindows,
+    SwissRDFSerializer,
+    dataset_fragments,
+    invalidate_dataset_fragments,
+)
 from ckanext.switzerland.dcat.profiles import (
+    DCAT,
     DCT,
     LANGUAGE_URI_MAPPING,
     SwissDCATAPProfile,
 )
 
+HYDRA = Namespace("http://www.w3.org/ns/hydra/core#")
+
 
 @pytest.fixture
 def profile():
@@ -173,3 +185,193 @@ def test_dataset_and_resource_handle_unknown_language_codes_gracefully(profile):
     # no triples should be created for unknown language codes
     assert langs_in_dataset_graph == []
     assert langs_in_resource_graph == []
+
+
+@pytest.mark.parametrize(
+    "_format,rdflib_format", [("ttl", "turtle"), ("nt", "nt"), ("xml", "xml")]
+)
+def test_streamed_catalog_equals_catalog_from_one_graph(_format, rdflib_format):
+    dataset_dicts = [
+        {
+            "id": "dataset-{}".format(i),
+            "name": "dataset-{}".format(i),
+            "uri": "http://example.org/dataset/{}".format(i),
+            "organization": {"name": "org-id"},
+            "language": ["de"],
+            "description": {"de": "<p>Beschreibung {}</p>".format(i)},
+            "resources": [],
+        }
+        for i in range(3)
+    ]
+    pagination_info = {"count": 3, "current": "http://example.org/catalog?page=1"}
+
+    streamed = SwissRDFSerializer(profiles=["swiss_dcat_ap"]).serialize_catalog(
+        {}, dataset_dicts, _format=_format, pagination_info=pagination_info
+    )
+    from_one_graph = RDFSerializer(profiles=["swiss_dcat_ap"]).serialize_catalog(
+        {}, dataset_dicts, _format="ttl", pagination_info=pagination_info
+    )
+
+    assert isomorphic(
+        rdflib.Graph().parse(data=streamed, format=rdflib_format),
+        rdflib.Graph().parse(data=from_one_graph, format="turtle"),
+    )
+
+
+def test_catalog_fragments_are_cached_until_the_dataset_is_modified():
+    dataset_dict = {
+        "id": "dataset-fragment",
+        "name": "dataset-fragment",
+        "uri": "http://example.org/dataset/fragment",
+        "metadata_modified": "2024-01-01T00:00:00",
+        "organization": {"name": "org-id"},
+        "version": "1.0",
+        "resources": [],
+    }
+    serializer = SwissRDFSerializer(profiles=["swiss_dcat_ap"])
+    invalidate_dataset_fragments(dataset_dict["id"])
+
+    first = serializer.serialize_catalog({}, [dataset_dict], _format="ttl")
+    assert (dataset_dict["id"], "turtle") in dataset_fragments
+
+    # The dataset has not been modified, so the cached fragment is used
+    cached = serializer.serialize_catalog(
+        {}, [dict(dataset_dict, version="2.0")], _format="ttl"
+    )
+    assert cached == first
+
+    modified = serializer.serialize_catalog(
+        {},
+        [dict(dataset_dict, version="2.0", metadata_modified="2024-01-02T00:00:00")],
+        _format="ttl",
+    )
+    assert "2.0" in modified
+
+    # Editing the organization does not modify the dataset
+    renamed = serializer.serialize_catalog(
+        {},
+        [
+            dict(
+                dataset_dict,
+                metadata_modified="2024-01-02T00:00:00",
+                organization={"name": "renamed-org"},
+            )
+        ],
+        _format="ttl",
+    )
+    assert "dataset-fragment@renamed-org" in renamed
+
+    invalidate_dataset_fragments(dataset_dict["id"])
+    assert (dataset_dict["id"], "turtle") not in dataset_fragments
+
+
+def test_line_based_windows_hold_the_statements_of_their_datasets():
+    catalog = rdflib.Graph().parse(
+        data="""
+        @prefix dcat: <http://www.w3.org/ns/dcat#> .
+        @prefix dct: <http://purl.org/dc/terms/> .
+        @prefix hydra: <http://www.w3.org/ns/hydra/core#> .
+        @prefix vcard: <http://www.w3.org/2006/vcard/ns#> .
+
+        <http://example.org/catalog> a dcat:Catalog ;
+            dcat:dataset <http://example.org/dataset/1>,
+                <http://example.org/dataset/2>,
+                <http://example.org/dataset/3> .
+
+        <http://example.org/dataset/1> a dcat:Dataset ;
+            dct:title "Dataset 1"@de ;
+            dct:relation <http://example.org/dataset/2> ;
+            dcat:contactPoint [ a vcard:Organization ; vcard:fn "Contact" ] ;
+            dcat:distribution <http://example.org/distribution/1> .
+        <http://example.org/dataset/2> a dcat:Dataset ;
+            dct:title "Dataset 2"@de .
+        <http://example.org/dataset/3> a dcat:Dataset ;
+            dct:title "Dataset 3"@de ;
+            dcat:distribution <http://example.org/distribution/3> .
+        <http://example.org/distribution/1> a dcat:Distribution ;
+            dct:title "Distribution 1"@de .
+        <http://example.org/distribution/3> a dcat:Distribution ;
+            dct:title "Distribution 3"@de .
+
+        <http://example.org/catalog?page=1> a hydra:PagedCollection ;
+            hydra:nextPage "http://example.org/catalog?page=2" .
+        """,
+        format="turtle",
+    )
+
+    # rdflib serialises the statements in no particular order
+    content = "\n".join(sorted(catalog.serialize(format="nt").splitlines()))
+    windows = LineBasedDatasetWindows(content, 2)
+    graphs = [rdflib.Graph().parse(data=window, format="nt") for window in windows]
+
+    assert [
+        sorted(str(s) for s in g.subjects(rdflib.RDF.type, DCAT.Dataset))
+        for g in graphs
+    ] == [
+        ["http://example.org/dataset/1", "http://example.org/dataset/2"],
+        ["http://example.org/dataset/3"],
+    ]
+    assert (None, HYDRA.nextPage, None) in graphs[0]
+    assert (None, HYDRA.nextPage, None) not in graphs[1]
+
+    # Apart from the catalog, every statement is in exactly one window
+    union = rdflib.Graph()
+    for g in graphs:
+        union += g
+    expected = rdflib.Graph()
+    for triple in catalog:
+        if triple[0] != rdflib.URIRef("http://example.org/catalog"):
+            expected.add(triple)
+    assert sum(len(g) for g in graphs) == len(expected)
+    assert isomorphic(union, expected)
+
+
+def test_parse_dataset(profile):
+    profile.g.parse(
+        data="""
+        @prefix dcat: <http://www.w3.org/ns/dcat#> .
+        @prefix dct: <http://purl.org/dc/terms/> .
+        @prefix foaf: <http://xmlns.com/foaf/0.1/> .
+        @prefix rdfs: <http://www.w3.org/2000/01/rdf-schema#> .
+        @prefix schema: <http://schema.org/> .
+        @prefix vcard: <http://www.w3.org/2006/vcard/ns#> .
+
+        <http://example.org/dataset/1> a dcat:Dataset ;
+            dct:identifier "dataset-1@org" ;
+            dct:title "Titel"@de, "Title"@en ;
+            dct:publisher <http://example.org/publisher> ;
+            dct:relation <http://example.org/relation> ;
+            dct:temporal [ a dct:PeriodOfTime ;
+                schema:startDate "2020-01-01" ;
+                schema:endDate "2020-12-31" ] ;
+            dcat:contactPoint [ a vcard:Organization ;
+                vcard:fn "Contact" ;
+                vcard:hasEmail <mailto:contact@example.org> ] ;
+            dcat:distribution <http://example.org/distribution/1> .
+
+        <http://example.org/publisher> foaf:name "Publisher"@de .
+        <http://example.org/relation> rdfs:label "Relation" .
+        <http://example.org/distribution/1> a dcat:Distribution ;
+            dct:title "Ressource"@de ;
+            dcat:accessURL <http://example.org/file.csv> .
+        """,
+        format="turtle",
+    )
+
+    dataset_dict = profile.parse_dataset(
+        {}, rdflib.URIRef("http://example.org/dataset/1")
+    )
+
+    assert dataset_dict["identifier"] == "dataset-1@org"
+    assert dataset_dict["title"] == {"de": "Titel", "en": "Title", "fr": "", "it": ""}
+    assert dataset_dict["publisher"]["uri"] == "http://example.org/publisher"
+    assert dataset_dict["publisher"]["name"]["de"] == "Publisher"
+    assert dataset_dict["relations"] == [
+        {"label": "Relation", "url": rdflib.URIRef("http://example.org/relation")}
+    ]
+    assert dataset_dict["contact_points"] == [
+        {"name": "Contact", "email": "contact@example.org"}
+    ]
+    assert len(dataset_dict["temporals"]) == 1
+    assert len(dataset_dict["resources"]) == 1
+    assert dataset_dict["resources"][0]["url"] == "http://example.org/file.csv"
@@ -1,5 +1,6 @@
 import json
 import os
+import re
 from datetime import datetime
 from time import sleep
 from zoneinfo import ZoneInfo
@@ -11,6 +12,7 @@ from ckan.logic import NotFound, get_action
 from mock import patch
 
 from ckanext.harvest import model as harvester_model
+from ckanext.switzerland.harvester.base_sbb_harvester import harvester_configs
 from ckanext.switzerland.harvester.sbb_harvester import SBBHarvester
 from ckanext.switzerland.tests.helpers.mock_ftp_storage_adapter import (
     MockFTPStorageAdapter,
@@ -67,6 +69,16 @@ class TestSBBHarvester(BaseSBBHarvesterTests):
             },
         )
 
+    def test_resource_dict_meta_is_not_modified(self):
+        resource_dict_meta = dict(self.harvester_class.resource_dict_meta)
+        MockFTPStorageAdapter.filesystem = self.get_filesystem()
+        self.run_harvester(ftp_server="testserver")
+
+        dataset = self.get_dataset()
+
+        self.assertTrue(dataset["resources"][0]["hash"])
+        self.assertEqual(self.harvester_class.resource_dict_meta, resource_dict_meta)
+
     def test_existing_dataset(self):
         data.dataset(slug="testslug-other-than-munge-name")
 
@@ -577,3 +589,51 @@ class TestSBBHarvester(BaseSBBHarvesterTests):
 
         for field in resource_datetime_fields:
             self.assertEqual(dataset["resources"][0][field], "2022-04-20T14:15:00")
+
+
+class TestSBBHarvesterConfig(object):
+    def setup_method(self):
+        harvester_configs.clear()
+
+    def _config_str(self, **config):
+        return json.dumps(
+            dict(
+                {
+                    "dataset": data.dataset_name,
+                    "environment": data.environment,
+                    "folder": data.folder,
+                    "filter_regex": r".*\.zip",
+                },
+                **config
+            )
+        )
+
+    def test_load_config_uses_the_config_validated_on_save(self):
+        config_str = self._config_str()
+        harvester = SBBHarvester()
+
+        harvester.validate_config(config_str)
+        config = harvester.load_config(config_str)
+
+        assert config["filter_regex"] == r".*\.zip"
+        assert SBBHarvester().load_config(config_str) is config
+        assert len(harvester_configs) == 1
+
+    def test_load_config_validates_a_changed_config(self):
+        harvester = SBBHarvester()
+        config = harvester.load_config(self._config_str())
+
+        changed = harvester.load_config(self._config_str(filter_regex=r".*\.csv"))
+
+        assert changed is not config
+        assert changed["filter_regex"] == r".*\.csv"
+
+    def test_pattern_is_compiled_once(self):
+        config = SBBHarvester().load_config(self._config_str())
+
+        pattern = config.pattern("filter_regex")
+
+        assert pattern.match("File.zip")
+        assert config.pattern("filter_regex") is pattern
+        assert config.pattern("filter_regex", re.IGNORECASE) is not pattern
+        assert config.pattern("filter_regex", re.IGNORECASE).match("FILE.ZIP")
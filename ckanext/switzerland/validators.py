@@ -8,13 +8,13 @@ import ckan.lib.navl.dictization_functions as df
 from ckan.common import asbool
 from ckan.lib.helpers import get_display_timezone
 from ckan.lib.munge import munge_tag
-from ckan.logic import NotFound, get_action
 from ckan.model import PACKAGE_NAME_MAX_LENGTH
 from ckan.plugins.toolkit import _, get_validator, missing
 
 from ckanext.scheming.helpers import date_tz_str_to_datetime, scheming_datetime_to_utc
 from ckanext.scheming.validation import scheming_validator, validate_date_inputs
 from ckanext.switzerland.helpers import get_langs, parse_json
+from ckanext.switzerland.logic import get_package_id_by_identifier
 
 log = logging.getLogger(__name__)
 name_match = re.compile(r"[a-z0-9_\-]*$")
@@ -304,14 +304,9 @@ def ogdch_unique_identifier(field, schema):
     def validator(key, data, errors, context):
         id = data.get(key[:-1] + ("id",))
         identifier = data.get(key[:-1] + ("identifier",))
-        try:
-            result = get_action("ogdch_dataset_by_identifier")(
-                {}, {"identifier": identifier}
-            )
-            if id != result["id"]:
-                raise df.Invalid(_("Identifier is already in use, it must be unique."))
-        except NotFound:
-            pass
+        package_id = get_package_id_by_identifier(identifier)
+        if package_id is not None and id != package_id:
+            raise df.Invalid(_("Identifier is already in use, it must be unique."))
 
     return validator
 